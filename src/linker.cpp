@@ -102,6 +102,7 @@ ElfLinker::ElfLinker()
     : bele(&N_BELE_RTP::le_policy), input(NULL), output(NULL), head(NULL), tail(NULL),
       sections(NULL), symbols(NULL), relocations(NULL), nsections(0), nsections_capacity(0),
       nsymbols(0), nsymbols_capacity(0), nrelocations(0), nrelocations_capacity(0),
+      section_index(NULL), nsection_index(0), symbol_index(NULL), nsymbol_index(0),
       reloc_done(false) {}
 
 ElfLinker::~ElfLinker() {
@@ -159,7 +160,13 @@ void ElfLinker::init(const void *pdata_v, int plen) {
     output = new upx_byte[inputlen ? inputlen : 0x4000];
     outputlen = 0;
 
-    if ((int) strlen("Sections:\n"
+    if (inputlen >= 32 && memcmp(input + inputlen - 4, "UPXO", 4) == 0) {
+        // binary link info appended by src/stub/scripts/objinfo.py
+        unsigned pos = get_le32(input + inputlen - 8);
+        assert(pos <= (unsigned) inputlen - 32);
+        preprocessObjinfo(input + pos, input + inputlen - 8);
+        addLoader("*UND*");
+    } else if ((int) strlen("Sections:\n"
                      "SYMBOL TABLE:\n"
                      "RELOCATION RECORDS FOR ") < inputlen) {
         int pos = find(input, inputlen, "Sections:\n", 10);
@@ -179,6 +186,82 @@ void ElfLinker::init(const void *pdata_v, int plen) {
     }
 }
 
+// see src/stub/scripts/objinfo.py for the format
+void ElfLinker::preprocessObjinfo(const upx_byte *start, const upx_byte *end) {
+    assert(memcmp(start, "UPXO", 4) == 0);
+    assert(get_le32(start + 4) == 2); // version
+    const unsigned ns = get_le32(start + 8);
+    const unsigned nsym = get_le32(start + 12);
+    const unsigned nrel = get_le32(start + 16);
+    const unsigned strsize = get_le32(start + 20);
+    const upx_byte *psections = start + 24;
+    const upx_byte *psymbols = psections + 16 * (upx_uint64_t) ns;
+    const upx_byte *prelocs = psymbols + 12 * (upx_uint64_t) nsym;
+    const upx_byte *pindex = prelocs + 24 * (upx_uint64_t) nrel;
+    const char *strings = (const char *) (pindex + 4 * ((upx_uint64_t) ns + 2 + nsym));
+    assert(24 + 20 * (upx_uint64_t) ns + 16 * (upx_uint64_t) nsym + 24 * (upx_uint64_t) nrel +
+               8 + strsize ==
+           (upx_uint64_t)(end - start));
+    assert(strsize > 0 && strings[strsize - 1] == 0);
+
+    if (update_capacity(ns + 2, &nsections_capacity))
+        sections =
+            static_cast<Section **>(realloc(sections, nsections_capacity * sizeof(Section *)));
+    assert(sections != NULL);
+    for (nsections = 0; nsections < ns; nsections++) {
+        const upx_byte *p = psections + 16 * nsections;
+        unsigned name = get_le32(p), offset = get_le32(p + 4), size = get_le32(p + 8);
+        assert(name < strsize);
+        // as in addSection(); duplicates are caught by the index check below
+        assert(strings[name] != 0 && strings[name + strlen(strings + name) - 1] != ':');
+        assert(offset <= (unsigned) inputlen && size <= (unsigned) inputlen - offset);
+        sections[nsections] = new Section(strings + name, input + offset, size, get_le32(p + 12));
+    }
+    addSection("*ABS*", NULL, 0, 0);
+    addSection("*UND*", NULL, 0, 0);
+
+    if (update_capacity(nsym, &nsymbols_capacity))
+        symbols = static_cast<Symbol **>(realloc(symbols, nsymbols_capacity * sizeof(Symbol *)));
+    assert(symbols != NULL);
+    for (nsymbols = 0; nsymbols < nsym; nsymbols++) {
+        const upx_byte *p = psymbols + 12 * nsymbols;
+        unsigned name = get_le32(p), section = get_le32(p + 4);
+        assert(name < strsize && section < nsections);
+        // as in addSymbol()
+        assert(strings[name] != 0 && strings[name + strlen(strings + name) - 1] != ':');
+        symbols[nsymbols] = new Symbol(strings + name, sections[section], get_le32(p + 8));
+    }
+
+    if (update_capacity(nrel, &nrelocations_capacity))
+        relocations = static_cast<Relocation **>(
+            realloc(relocations, nrelocations_capacity * sizeof(Relocation *)));
+    assert(relocations != NULL);
+    for (nrelocations = 0; nrelocations < nrel; nrelocations++) {
+        const upx_byte *p = prelocs + 24 * nrelocations;
+        unsigned section = get_le32(p), type = get_le32(p + 8), symbol = get_le32(p + 12);
+        assert(section < nsections && type < strsize && symbol < nsymbols);
+        upx_uint64_t add = get_le32(p + 16) | ((upx_uint64_t) get_le32(p + 20) << 32);
+        relocations[nrelocations] = new Relocation(sections[section], get_le32(p + 4),
+                                                   strings + type, symbols[symbol], add);
+    }
+
+    // the name indices were sorted at build time; findSection() and
+    // findSymbol() need strictly increasing names, which also rules out
+    // duplicates
+    const char *prev = NULL;
+    for (unsigned ic = 0; ic < nsections + nsymbols; ic++) {
+        unsigned i = get_le32(pindex + 4 * ic);
+        assert(i < (ic < nsections ? nsections : nsymbols));
+        const char *name = ic < nsections ? sections[i]->name : symbols[i]->name;
+        assert(ic == 0 || ic == nsections || strcmp(prev, name) < 0);
+        prev = name;
+    }
+    section_index = pindex;
+    nsection_index = nsections;
+    symbol_index = pindex + 4 * nsections;
+    nsymbol_index = nsymbols;
+}
+
 void ElfLinker::preprocessSections(char *start, char *end) {
     char *nextl;
     for (nsections = 0; start < end; start = 1 + nextl) {
@@ -293,7 +376,20 @@ void ElfLinker::preprocessRelocations(char *start, char *end) {
 }
 
 ElfLinker::Section *ElfLinker::findSection(const char *name, bool fatal) const {
-    for (unsigned ic = 0; ic < nsections; ic++)
+    // binary search in the name index, then scan the sections added later
+    unsigned lo = 0, hi = nsection_index;
+    while (lo < hi) {
+        unsigned mid = (lo + hi) / 2;
+        Section *section = sections[get_le32(section_index + 4 * mid)];
+        int r = strcmp(section->name, name);
+        if (r == 0)
+            return section;
+        if (r < 0)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    for (unsigned ic = nsection_index; ic < nsections; ic++)
         if (strcmp(sections[ic]->name, name) == 0)
             return sections[ic];
     if (fatal)
@@ -302,7 +398,19 @@ ElfLinker::Section *ElfLinker::findSection(const char *name, bool fatal) const {
 }
 
 ElfLinker::Symbol *ElfLinker::findSymbol(const char *name, bool fatal) const {
-    for (unsigned ic = 0; ic < nsymbols; ic++)
+    unsigned lo = 0, hi = nsymbol_index;
+    while (lo < hi) {
+        unsigned mid = (lo + hi) / 2;
+        Symbol *symbol = symbols[get_le32(symbol_index + 4 * mid)];
+        int r = strcmp(symbol->name, name);
+        if (r == 0)
+            return symbol;
+        if (r < 0)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    for (unsigned ic = nsymbol_index; ic < nsymbols; ic++)
         if (strcmp(symbols[ic]->name, name) == 0)
             return symbols[ic];
     if (fatal)
@@ -61,9 +61,17 @@ protected:
     unsigned nrelocations;
     unsigned nrelocations_capacity;
 
+    // name indices from the binary link info: the first nsection_index
+    // sections and nsymbol_index symbols, sorted by name
+    const upx_byte *section_index;
+    unsigned nsection_index;
+    const upx_byte *symbol_index;
+    unsigned nsymbol_index;
+
     bool reloc_done;
 
 protected:
+    void preprocessObjinfo(const upx_byte *start, const upx_byte *end);
     void preprocessSections(char *start, char *end);
     void preprocessSymbols(char *start, char *end);
     void preprocessRelocations(char *start, char *end);
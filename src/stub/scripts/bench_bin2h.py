@@ -0,0 +1,291 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  bench_bin2h.py -- benchmark bin2h.py
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+import getopt, glob, os, shutil, struct, subprocess, sys, tempfile, time, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bin2h
+
+
+class opts:
+    batch = 0
+    compile = 0
+    cxx = os.environ.get("CXX", "g++")
+    decode = 0
+    loops = 10
+    verbose = 0
+
+
+# /***********************************************************************
+# // reference writers - one w() call per byte, as in UPX 3.94
+# ************************************************************************/
+
+def ref_w_data(w, data, mode):
+    n = len(data)
+    if mode in ["gas-be32", "gas-le32"]:
+        decode = {"gas-be32": ">i", "gas-le32": "<i"}[mode]
+        for i in range(0, n, 4):
+            if i & 15 == 0:
+                if i: w("\n")
+                w("/* 0x%04x */ .int " % i)
+            else:
+                w(",")
+            v = struct.unpack(decode, data[i:i+4])
+            w("0x%08x" % (v[0] & 0xffffffffL))
+        if n: w("\n")
+        return
+    for i in range(n):
+        if i & 15 == 0:
+            if mode == "nasm":
+                if i: w("   ; 0x%04x\n" % (i - 16))
+                w("db ")
+            else:
+                if i: w("\n")
+                w("/* 0x%04x */ " % i)
+                if mode == "gas": w(".byte ")
+        elif mode != "c":
+            w(",")
+        w("%3d" % ord(data[i]))
+        if mode == "c" and i != n - 1: w(",")
+    if n:
+        if mode == "nasm":
+            w(" " * 4 * (((n + 15) & ~15) - n))
+            w("   ; 0x%04x\n" % ((n - 1) & ~15))
+        else:
+            w("\n")
+
+
+def new_w_data(w, data, mode):
+    bin2h.DATA_WRITERS[mode](w).w_data(data)
+
+
+# /***********************************************************************
+# // per-file invocation vs. one --manifest batch run
+# ************************************************************************/
+
+def bench_batch(args):
+    bin2h_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin2h.py")
+    python = sys.executable or "python"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmpdir, "single"))
+        os.mkdir(os.path.join(tmpdir, "batch"))
+        def ofile(d, fn):
+            return os.path.join(tmpdir, d, os.path.basename(fn) + ".h")
+        t0 = time.time()
+        for fn in args:
+            subprocess.check_call([python, bin2h_py, "--ident=auto-stub", fn, ofile("single", fn)])
+        t_single = time.time() - t0
+        manifest = os.path.join(tmpdir, "manifest")
+        fp = open(manifest, "wb")
+        for fn in args:
+            fp.write("%s %s\n" % (fn, ofile("batch", fn)))
+        fp.close()
+        t0 = time.time()
+        subprocess.check_call([python, bin2h_py, "--ident=auto-stub", "--manifest=" + manifest])
+        t_batch = time.time() - t0
+        for fn in args:
+            s1 = open(ofile("single", fn), "rb").read()
+            s2 = open(ofile("batch", fn), "rb").read()
+            assert s1 == s2, ("output differs", fn)
+    finally:
+        shutil.rmtree(tmpdir)
+    print "%d stubs  per-file %8.2f ms  manifest %8.2f ms  speedup %5.2fx" % (len(args), t_single * 1000, t_batch * 1000, t_single / max(t_batch, 1e-9))
+
+
+# /***********************************************************************
+# // compiling a C array header vs. an --mode=incbin header
+# ************************************************************************/
+
+# run a command, return (seconds, max RSS in KiB)
+def run_rusage(args):
+    t0 = time.time()
+    p = subprocess.Popen(args)
+    pid, status, ru = os.wait4(p.pid, 0)
+    t = time.time() - t0
+    assert status == 0, ("command failed", args)
+    return t, ru.ru_maxrss
+
+
+def bench_compile(args):
+    bin2h_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin2h.py")
+    python = sys.executable or "python"
+    tmpdir = tempfile.mkdtemp()
+    total = {"c": [0.0, 0], "incbin": [0.0, 0]}
+    try:
+        for i, fn in enumerate(args):
+            ident = "stub_%d" % i
+            for mode in ["c", "incbin"]:
+                base = os.path.join(tmpdir, "%s_%d" % (mode, i))
+                subprocess.check_call([python, bin2h_py, "--ident=" + ident, "--mode=" + mode, "--compress=0,15", "--deflate-search=0", fn, base + ".h"])
+                fp = open(base + ".cpp", "wb")
+                fp.write("#define STUB_COMPRESS_METHOD 15\n")
+                fp.write("#include \"%s\"\n" % os.path.basename(base + ".h"))
+                fp.write("unsigned stub_size() { return sizeof(%s); }\n" % ident)
+                fp.close()
+                t, rss = run_rusage([opts.cxx, "-O2", "-c", "-o", base + ".o", "-I" + tmpdir, base + ".cpp"])
+                if mode == "incbin":
+                    t2, rss2 = run_rusage([opts.cxx, "-c", "-o", base + ".S.o", "-Wa,-I" + tmpdir, base + ".S"])
+                    t, rss = t + t2, max(rss, rss2)
+                total[mode][0] += t
+                total[mode][1] = max(total[mode][1], rss)
+                if opts.verbose >= 1:
+                    print "%-7s %8.2f ms %8d KiB  %s" % (mode, t * 1000, rss, fn)
+    finally:
+        shutil.rmtree(tmpdir)
+    for mode in ["c", "incbin"]:
+        print "%-7s %d stubs  compile %9.2f ms  max RSS %8d KiB" % (mode, len(args), total[mode][0] * 1000, total[mode][1])
+
+
+# /***********************************************************************
+# // decompression speed of the compressed stub methods
+# ************************************************************************/
+
+# Decode a compressed stub with Python's zlib and liblzma; the port of
+# LzmaDecode() in bin2h.py is exact but far too slow to time.
+def native_decode(odata):
+    method, u_len, c_len, h = bin2h.decode_compressed_stub_header(odata)
+    data = odata[h:h+c_len]
+    if method == 14: # M_LZMA
+        pb, lp, lc = ord(data[0]) & 7, ord(data[1]) >> 4, ord(data[1]) & 15
+        f = bin2h.lzma_filter("\0" * u_len, lc, lp, pb)
+        d = bin2h.lzma.LZMADecompressor(format=bin2h.lzma.FORMAT_RAW, filters=[f])
+        return d.decompress(data[2:])[:u_len]
+    return zlib.decompress(data, -15)
+
+
+# Best time of one native_decode() call. Each sample repeats the
+# decoding for at least min_time seconds to get above the timer
+# resolution.
+def decode_latency(odata, samples=5, min_time=0.002):
+    best = None
+    for i in range(samples):
+        n = 0
+        t0 = time.time()
+        while 1:
+            native_decode(odata)
+            n += 1
+            t = time.time() - t0
+            if t >= min_time:
+                break
+        if best is None or t / n < best:
+            best = t / n
+    return best
+
+
+# The timings come from Python's zlib and liblzma, not from the decoders
+# linked into upx, so compare methods relative to each other rather
+# than reading the absolute numbers as upx startup cost. The "model"
+# column is the fixed estimate bin2h.DECODE_COST gives --compress=auto.
+def bench_decode(args):
+    total = {}
+    for fn in args:
+        idata = open(fn, "rb").read()
+        for method in [14, 15]:
+            m, odata, info = bin2h.compress_stub(method, idata)
+            if m == 0:
+                continue
+            assert bin2h.decompress_stub(odata) == idata, ("round-trip failed", fn, method)
+            assert native_decode(odata) == idata, ("native round-trip failed", fn, method)
+            t = decode_latency(odata, samples=opts.loops)
+            model = bin2h.decode_cost(method, odata) * 1e-9
+            tot = total.setdefault(method, [0, 0, 0.0, 0.0])
+            tot[0] += len(idata); tot[1] += len(odata); tot[2] += t; tot[3] += model
+            if opts.verbose >= 0:
+                print "m%-2d %6d -> %6d  %8.1f us  %7.1f MB/s  model %8.1f us  %s" % (method, len(idata), len(odata), t * 1e6, len(idata) / t / 1e6, model * 1e6, fn)
+    for method in sorted(total.keys()):
+        u_len, c_len, t, model = total[method]
+        print "m%-2d total %8d -> %8d bytes (%5.1f%%)  %10.1f us  %7.1f MB/s  model %10.1f us" % (method, u_len, c_len, 100.0 * c_len / u_len, t * 1e6, u_len / t / 1e6, model * 1e6)
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def bench(f, data, mode):
+    best = None
+    for loop in range(opts.loops):
+        out = []
+        t0 = time.time()
+        f(out.append, data, mode)
+        t = time.time() - t0
+        if best is None or t < best: best = t
+    return best, "".join(out)
+
+
+def main(argv):
+    shortopts, longopts = "qv", ["batch", "compile", "cxx=", "decode", "loops=", "no-search", "quiet", "verbose"]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--batch"]: opts.batch = opts.batch + 1
+        elif opt in ["--compile"]: opts.compile = opts.compile + 1
+        elif opt in ["--cxx"]: opts.cxx = optarg
+        elif opt in ["--decode"]: opts.decode = opts.decode + 1
+        elif opt in ["--loops"]: opts.loops = int(optarg)
+        elif opt in ["--no-search"]: bin2h.opts.deflate_search = bin2h.opts.lzma_search = 0
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    if not args:
+        args = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tmp", "*.bin")))
+    if not args:
+        raise Exception, "error: no input files given and no tmp/*.bin stubs found"
+    if opts.batch:
+        bench_batch(args)
+        return 0
+    if opts.compile:
+        bench_compile(args)
+        return 0
+    if opts.decode:
+        bench_decode(args)
+        return 0
+
+    total = {}
+    for mode in ["c", "gas", "gas-be32", "gas-le32", "nasm"]:
+        t_ref = t_new = 0.0
+        nbytes = 0
+        for fn in args:
+            data = open(fn, "rb").read()
+            if mode.endswith("32") and len(data) % 4 != 0:
+                continue
+            t1, s1 = bench(ref_w_data, data, mode)
+            t2, s2 = bench(new_w_data, data, mode)
+            assert s1 == s2, ("output differs", fn, mode)
+            t_ref += t1; t_new += t2; nbytes += len(data)
+            if opts.verbose >= 1:
+                print "%-9s %8.2f ms %8.2f ms  %s" % (mode, t1 * 1000, t2 * 1000, fn)
+        if nbytes:
+            print "%-9s %9d bytes  per-byte %8.2f ms  per-row %8.2f ms  speedup %5.2fx" % (mode, nbytes, t_ref * 1000, t_new * 1000, t_ref / max(t_new, 1e-9))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  bench_gpp_inc.py -- compare the gpp_inc.py scanner with the line-based one
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage:
+#   python scripts/bench_gpp_inc.py [--loops=N] [--jobs=N] [-I DIR]... [FILE...]
+#
+# Preprocesses every FILE (default: src/stub/src/*.S) in c and nasm mode
+# with both the previous line-based gpp_inc (readlines, one re.search
+# and one write per line, no caches) and the current one, checks that
+# output and dependencies are identical and prints the best of N times.
+# The last column is the dependency-only scan (gpp_mkdep), which must
+# find the same dependencies as the full preprocess.
+#
+
+
+import cStringIO, getopt, glob, os, re, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gpp_inc
+
+
+class opts:
+    includes = []
+    jobs = 1
+    loops = 5
+    verbose = 0
+
+
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+# /***********************************************************************
+# // the previous line-based gpp_inc
+# ************************************************************************/
+
+def ref_not_found(state, l, inc, fatal=None):
+    if fatal is None:
+        fatal = gpp_inc.opts.fatal
+    if fatal:
+        raise Exception, "%s:%d: include file %s not found" % (state[0], state[2], inc)
+    return l
+
+
+def ref_handle_inc_c(state, l, ofp):
+    m = re.search(r"^\s*\#\s*include\s+([\"\<])(.+?)([\"\>])(.*)$", l)
+    if not m:
+        return l
+    q1, inc, q2, comment = m.groups()
+    cf = gpp_inc.parse_comment(state, l, comment)
+    if q1 == '<' and q2 == '>':
+        dirs = gpp_inc.opts.includes
+    elif q1 == '"' and q2 == '"':
+        dirs = [state[1]] + gpp_inc.opts.includes
+    else:
+        raise Exception, "syntax error: include line " + l
+    for dir in dirs:
+        fn = os.path.join(dir, inc)
+        if os.path.isfile(fn):
+            gpp_inc.add_dep(state, fn, q1 == '<')
+            ref_handle_file(fn, ofp, state)
+            return None
+    return ref_not_found(state, l, inc, cf.get("fatal"))
+
+
+def ref_handle_inc_nasm(state, l, ofp):
+    m = re.search(r"^\s*\%\s*include\s+([\"\<])(.+?)([\"\>])(.*)$", l)
+    if not m:
+        return l
+    q1, inc, q2, comment = m.groups()
+    cf = gpp_inc.parse_comment(state, l, comment)
+    if q1 == '<' and q2 == '>':
+        pass
+    elif q1 == '"' and q2 == '"':
+        pass
+    else:
+        raise Exception, "syntax error: include line " + l
+    for prefix in gpp_inc.opts.includes + [""]:
+        fn = prefix + inc
+        if os.path.isfile(fn):
+            gpp_inc.add_dep(state, fn, False)
+            ref_handle_file(fn, ofp, state)
+            return None
+    return ref_not_found(state, l, inc, cf.get("fatal"))
+
+
+def ref_handle_file(ifn, ofp, parent_state=None):
+    state = [ifn, os.path.dirname(ifn) or ".", 0, parent_state]
+    ifp = open(ifn, "rb")
+    for l in ifp.readlines():
+        state[2] += 1       # line counter
+        l = l.rstrip("\n")
+        if gpp_inc.opts.mode == "c":
+            l = ref_handle_inc_c(state, l, ofp)
+        elif gpp_inc.opts.mode == "nasm":
+            l = ref_handle_inc_nasm(state, l, ofp)
+        if l is not None:
+            ofp.write(l + "\n")
+
+
+def ref_preprocess(ifn, includes, mode, fatal=1):
+    saved = (gpp_inc.opts.includes, gpp_inc.opts.mode, gpp_inc.opts.fatal,
+             gpp_inc.files_md, gpp_inc.files_mmd, gpp_inc.files_st)
+    gpp_inc.opts.includes, gpp_inc.opts.mode, gpp_inc.opts.fatal = list(includes), mode, fatal
+    gpp_inc.files_md, gpp_inc.files_mmd, gpp_inc.files_st = [], [], {}
+    try:
+        ofp = cStringIO.StringIO()
+        ref_handle_file(ifn, ofp)
+        return ofp.getvalue(), gpp_inc.files_mmd
+    finally:
+        (gpp_inc.opts.includes, gpp_inc.opts.mode, gpp_inc.opts.fatal,
+         gpp_inc.files_md, gpp_inc.files_mmd, gpp_inc.files_st) = saved
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def run_all(f, files, mode):
+    results = []
+    t0 = time.time()
+    for fn in files:
+        try:
+            results.append(f(fn, opts.includes, mode))
+        except Exception, e:
+            results.append(str(e))
+    return time.time() - t0, results
+
+
+def best_of(f, files, mode):
+    best = None
+    for i in range(opts.loops):
+        t, results = run_all(f, files, mode)
+        if best is None or t < best:
+            best = t
+    return best, results
+
+
+def expand_deps(fn, includes, mode):
+    r = gpp_inc.expand(fn, includes, mode)
+    return r["md"], r["mmd"]
+
+
+def scan_deps(fn, includes, mode):
+    r = gpp_inc.scan_deps(fn, includes, mode, jobs=opts.jobs)
+    return r["md"], r["mmd"]
+
+
+def main(argv):
+    shortopts, longopts = "qvI:", ["jobs=", "loops=", "quiet", "verbose"]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["-I"]: opts.includes.append(optarg)
+        elif opt in ["--jobs"]: opts.jobs = int(optarg)
+        elif opt in ["--loops"]: opts.loops = int(optarg)
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    files = args or sorted(glob.glob(os.path.join(SRC_DIR, "*.S")))
+    if not files:
+        raise Exception, "error: no files given"
+    print "%-6s %6s %10s %10s %10s %8s %10s %8s" % ("mode", "files", "bytes", "lines ms", "buffer ms", "speedup", "deps ms", "share")
+    for mode in ["c", "nasm"]:
+        times = []
+        outputs = []
+        for f in [ref_preprocess, gpp_inc.preprocess]:
+            t, results = best_of(f, files, mode)
+            times.append(t)
+            outputs.append(results)
+        for fn, r, n in zip(files, outputs[0], outputs[1]):
+            assert r == n, (fn, mode, "outputs differ")
+        t_deps, deps = best_of(scan_deps, files, mode)
+        for fn, r, n in zip(files, run_all(expand_deps, files, mode)[1], deps):
+            assert r == n, (fn, mode, "dependencies differ")
+        nbytes = sum([len(r[0]) for r in outputs[1] if isinstance(r, tuple)])
+        print "%-6s %6d %10d %10.1f %10.1f %7.2fx %10.1f %7.1f%%" % (mode, len(files), nbytes, times[0] * 1000, times[1] * 1000,
+            times[0] / max(times[1], 1e-9), t_deps * 1000, 100.0 * t_deps / max(times[1], 1e-9))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  bench_objinfo.py -- compare the text and binary link info of the stubs
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage (from src/stub, after a build):
+#   python scripts/bench_objinfo.py tmp/*.bin
+#
+# Every tmp/T.bin needs its tmp/T.bin.dump. For each stub all link
+# info formats (text, text-min, bin) are built, and a small driver
+# compiled from src/linker.cpp times ElfLinker::init() and a lookup of
+# every section and symbol name on each, and checks that all give the
+# same sections, symbols and relocations. The UCL headers are needed to compile
+# src/*.cpp: pass --cppflags=-I.../include or set UPX_UCLDIR.
+#
+
+
+import getopt, os, shutil, subprocess, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import objinfo
+
+
+class opts:
+    cppflags = []
+    cxx = os.environ.get("CXX", "g++")
+    loops = 200
+    verbose = 0
+
+
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+SOURCES = ["linker.cpp", "except.cpp", "snprintf.cpp", "util.cpp"]
+
+DRIVER = r'''
+#include "conf.h"
+#include "linker.h"
+#include <time.h>
+
+// the stubs are not compressed here
+int upx_decompress(const upx_bytep, unsigned, upx_bytep, unsigned *, int,
+                   const upx_compress_result_t *) {
+    throwInternalError("upx_decompress");
+    return -1;
+}
+static options_t global_options;
+options_t *opt = &global_options;
+
+struct DumpLinker : public ElfLinker {
+    // look up every section and symbol by name
+    void lookup() const {
+        for (unsigned ic = 0; ic < nsections; ic++)
+            assert(findSection(sections[ic]->name) == sections[ic]);
+        for (unsigned ic = 0; ic < nsymbols; ic++)
+            assert(findSymbol(symbols[ic]->name) == symbols[ic]);
+    }
+    void dump(FILE *fp) const {
+        for (unsigned ic = 0; ic < nsections; ic++) {
+            const Section *s = sections[ic];
+            fprintf(fp, "section %s %u %u ", s->name, s->size, s->p2align);
+            for (unsigned j = 0; j < s->size; j++)
+                fprintf(fp, "%02x", ((const unsigned char *) s->input)[j]);
+            fprintf(fp, "\n");
+        }
+        for (unsigned ic = 0; ic < nsymbols; ic++)
+            fprintf(fp, "symbol %s %s %llx\n", symbols[ic]->name, symbols[ic]->section->name,
+                    (unsigned long long) symbols[ic]->offset);
+        for (unsigned ic = 0; ic < nrelocations; ic++) {
+            const Relocation *r = relocations[ic];
+            fprintf(fp, "reloc %s %x %s %s %llx\n", r->section->name, r->offset, r->type,
+                    r->value->name, (unsigned long long) r->add);
+        }
+    }
+};
+
+static double now() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+// usage: driver dump FILE | driver time FILE LOOPS
+int main(int argc, char **argv) {
+    assert(argc >= 3);
+    FILE *fp = fopen(argv[2], "rb");
+    assert(fp != NULL);
+    fseek(fp, 0, SEEK_END);
+    long len = ftell(fp);
+    fseek(fp, 0, SEEK_SET);
+    upx_byte *buf = new upx_byte[len + 1];
+    if (fread(buf, 1, len, fp) != (size_t) len)
+        return 1;
+    fclose(fp);
+    if (strcmp(argv[1], "dump") == 0) {
+        DumpLinker l;
+        l.init(buf, (int) len);
+        l.dump(stdout);
+        return 0;
+    }
+    int loops = atoi(argv[3]);
+    double t0 = now();
+    for (int i = 0; i < loops; i++) {
+        ElfLinker *l = new ElfLinker;
+        l->init(buf, (int) len);
+        delete l;
+    }
+    double t1 = now();
+    DumpLinker l;
+    l.init(buf, (int) len);
+    for (int i = 0; i < loops; i++)
+        l.lookup();
+    printf("%.9f %.9f\n", (t1 - t0) / loops, (now() - t1) / loops);
+    return 0;
+}
+'''
+
+
+# /***********************************************************************
+# // util
+# ************************************************************************/
+
+def read_file(fn):
+    fp = open(fn, "rb")
+    data = fp.read()
+    fp.close()
+    return data
+
+
+def write_file(fn, data):
+    fp = open(fn, "wb")
+    fp.write(data)
+    fp.close()
+
+
+# the stripped object of a stub built with either link info format
+def stub_object(data):
+    r = objinfo.unpack_objinfo(data)
+    if r is not None:
+        return data[:r[1]]
+    p = data.rfind("file format ")
+    assert p >= 0, "no link info"
+    return data[:p]
+
+
+def build_driver(tmpdir):
+    cppflags = ["-I" + SRC_DIR] + opts.cppflags
+    if os.environ.get("UPX_UCLDIR"):
+        cppflags.append("-I" + os.path.join(os.environ["UPX_UCLDIR"], "include"))
+    write_file(os.path.join(tmpdir, "driver.cpp"), DRIVER)
+    exe = os.path.join(tmpdir, "driver")
+    srcs = [os.path.join(tmpdir, "driver.cpp")] + [os.path.join(SRC_DIR, f) for f in SOURCES]
+    subprocess.check_call([opts.cxx, "-O2", "-funsigned-char", "-fno-strict-aliasing", "-fwrapv"] + cppflags + ["-o", exe] + srcs)
+    return exe
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def main(argv):
+    shortopts, longopts = "qv", ["cppflags=", "cxx=", "loops=", "quiet", "verbose"]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--cppflags"]: opts.cppflags += optarg.split()
+        elif opt in ["--cxx"]: opts.cxx = optarg
+        elif opt in ["--loops"]: opts.loops = int(optarg)
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    if not args:
+        raise Exception, "error: no stubs given"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        exe = build_driver(tmpdir)
+        formats = ["text", "text-min", "bin"]
+        totals = [[0, 0.0, 0.0] for f in formats]
+        def row(name, cols):
+            size = " ".join(["%8d" % c[0] for c in cols])
+            init = " ".join(["%13.1f" % (c[1] * 1e6) for c in cols])
+            lookup = " ".join(["%13.1f" % (c[2] * 1e6) for c in cols])
+            return "%-40s %s %s %6.1fx %s %6.1fx" % (name, size, init, cols[0][1] / max(cols[-1][1], 1e-12),
+                                                     lookup, cols[0][2] / max(cols[-1][2], 1e-12))
+        print "%-40s %s %s %7s %s %7s" % ("stub", " ".join(["%8s" % f for f in formats]),
+            " ".join(["%13s" % ("init " + f) for f in formats]), "speedup",
+            " ".join(["%13s" % ("look " + f) for f in formats]), "speedup")
+        for fn in args:
+            dump = read_file(fn + ".dump")
+            elf = stub_object(read_file(fn))
+            cols = []
+            outputs = []
+            for format in formats:
+                info = objinfo.objinfo(elf, dump, format)[1]
+                tfn = os.path.join(tmpdir, "stub." + format)
+                write_file(tfn, elf + info)
+                outputs.append(subprocess.Popen([exe, "dump", tfn], stdout=subprocess.PIPE).communicate()[0])
+                t = subprocess.Popen([exe, "time", tfn, str(opts.loops)], stdout=subprocess.PIPE).communicate()[0]
+                cols.append([len(info)] + map(float, t.split()))
+            for format, output in zip(formats[1:], outputs[1:]):
+                assert output == outputs[0], (fn, "link info formats differ", format)
+            totals = [map(sum, zip(t, c)) for t, c in zip(totals, cols)]
+            print row(os.path.basename(fn), cols)
+        print row("total", totals)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  bench_xstrip.py -- benchmark xstrip.py on large synthetic ELF files
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+import getopt, os, resource, shutil, struct, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import xstrip
+
+
+class opts:
+    sizes = [1, 16, 64]     # MiB
+    verbose = 0
+
+
+# /***********************************************************************
+# // synthetic objects
+# ************************************************************************/
+
+# An ELF64 LE relocatable laid out like objcopy-2.17 output: one large
+# PROGBITS section, .shstrtab, the section headers, then .symtab and
+# .strtab.
+def make_elf(fn, payload_size):
+    shstrtab = xstrip.SHSTRTAB_NAMES + ".data\0"
+    symtab = "\0" * 48
+    strtab = "\0x\0"
+    o_data = 64
+    o_shstrtab = o_data + payload_size
+    e_shoff = (o_shstrtab + len(shstrtab) + 7) & -8
+    o_symtab = e_shoff + 5 * 64
+    o_strtab = o_symtab + len(symtab)
+    def shdr(name, type, offset, size, link=0, entsize=0):
+        return struct.pack("<IIQQQQIIQQ", name, type, 0, 0, offset, size, link, 0, 1, entsize)
+    shdrs = [
+        shdr(0, 0, 0, 0),
+        shdr(shstrtab.index(".data"), 1, o_data, payload_size),
+        shdr(shstrtab.index(".shstrtab"), 3, o_shstrtab, len(shstrtab)),
+        shdr(shstrtab.index(".symtab"), 2, o_symtab, len(symtab), 4, 24),
+        shdr(shstrtab.index(".strtab"), 3, o_strtab, len(strtab)),
+    ]
+    eh = "\x7fELF\x02\x01\x01" + "\0" * 9
+    eh += struct.pack("<HHIQQQIHHHHHH", 1, 62, 1, 0, 0, e_shoff, 0, 64, 0, 0, 64, 5, 2)
+    fp = open(fn, "wb")
+    fp.write(eh)
+    block = "".join([chr(i & 255) for i in range(1 << 16)])
+    n = payload_size
+    while n > 0:
+        fp.write(block[:min(n, len(block))])
+        n -= len(block)
+    fp.write(shstrtab)
+    fp.write("\0" * (e_shoff - fp.tell()))
+    fp.write("".join(shdrs) + symtab + strtab)
+    fp.close()
+    return o_shstrtab
+
+
+# /***********************************************************************
+# // measure
+# ************************************************************************/
+
+# the previous xstrip.do_file(): read everything, write everything back
+def ref_do_file(fn):
+    fp = open(fn, "r+b")
+    idata = fp.read()
+    odata = xstrip.strip_elf(idata, None, fn)
+    if odata:
+        fp.seek(0, 0)
+        fp.write(odata)
+        fp.truncate()
+    fp.close()
+
+
+def read_proc_io():
+    d = {}
+    try:
+        for l in open("/proc/self/io", "rb").readlines():
+            k, v = l.split(":")
+            d[k.strip()] = int(v)
+    except IOError:
+        pass
+    return d
+
+
+# run f(fn) in a child process; returns (seconds, max RSS KiB, rchar, wchar)
+def measure(f, fn):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        io0 = read_proc_io()
+        t0 = time.time()
+        f(fn)
+        t = time.time() - t0
+        io1 = read_proc_io()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        io = [io1.get(k, 0) - io0.get(k, 0) for k in ["rchar", "wchar"]]
+        os.write(w, "%r %d %d %d" % (t, rss - rss0, io[0], io[1]))
+        os._exit(0)
+    os.close(w)
+    s = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    t, rss, rchar, wchar = s.split()
+    return float(t), int(rss), int(rchar), int(wchar)
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def main(argv):
+    shortopts, longopts = "qv", ["quiet", "sizes=", "verbose"]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--sizes"]: opts.sizes = map(int, optarg.split(","))
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print "%-8s %8s %10s %12s %12s %12s" % ("method", "MiB", "ms", "RSS+ KiB", "read", "written")
+        for size in opts.sizes:
+            src = os.path.join(tmpdir, "src.o")
+            new_len = make_elf(src, size << 20)
+            results = []
+            for name, f in [("read", ref_do_file), ("mmap", xstrip.do_file)]:
+                fn = os.path.join(tmpdir, name + ".o")
+                shutil.copyfile(src, fn)
+                t, rss, rchar, wchar = measure(f, fn)
+                results.append(open(fn, "rb").read())
+                assert os.path.getsize(fn) == new_len, (name, os.path.getsize(fn), new_len)
+                print "%-8s %8d %10.2f %12d %12d %12d" % (name, size, t * 1000, rss, rchar, wchar)
+            assert results[0] == results[1], "outputs differ"
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
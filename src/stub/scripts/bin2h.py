@@ -28,15 +28,35 @@
 #
 
 
-import getopt, os, re, struct, sys, zlib
+import array, getopt, hashlib, multiprocessing, os, re, shlex, struct, sys, time, zlib
+
+import outfile, stubmetrics
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 class opts:
+    cache_dir = None
+    auto_weight = 0.25
+    cache_size = 64*1024*1024
+    compress_auto = 0
+    deflate_search = 1
     dry_run = 0
     ident = None
+    jobs = 0
+    lzma_search = 1
+    manifest = None
     methods = [ 0 ]
+    metrics = None
     mname = "STUB_COMPRESS_METHOD"
     mode = "c"
+    obj_format = "elf64-x86-64"
     verbose = 0
 
 
@@ -81,87 +101,81 @@ def w_header_c(w, ifile, ofile, n):
 # // write data
 # ************************************************************************/
 
+# All writers convert the whole data to a list of value strings at once
+# (using precomputed tables) and then render each 16-byte row with
+# a single string join.
+
+BYTE_STR = ["%3d" % i for i in range(256)]
+# array typecode of an unsigned 32-bit integer
+ARRAY_U32 = [t for t in "IL" if array.array(t).itemsize == 4][0]
+
+
 class DataWriter:
+    BYTES_PER_ROW = 16
+    BYTES_PER_VALUE = 1
+    PREFIX = ""
+
     def __init__(self, w):
         self.w = w
-        self.pos = None
 
-    def w_bol(self, pos):
-        self.w("/* 0x%04x */ " % (pos))
-        self.pos = pos
-    def w_eol(self, fill=""):
-        if self.pos is not None:
-            self.w(fill.rstrip() + "\n")
+    def values(self, data):
+        return map(BYTE_STR.__getitem__, bytearray(data))
 
+    # return the text of the row starting at data offset "pos"
+    def row(self, pos, values, last):
+        return "/* 0x%04x */ %s%s\n" % (pos, self.PREFIX, ",".join(values))
 
-class DataWriter_c(DataWriter):
     def w_data(self, data):
-        w, n = self.w, len(data)
-        for i in range(n):
-            if i & 15 == 0:
-                self.w_eol()
-                self.w_bol(i)
-            w("%3d" % ord(data[i]))
-            if i != n - 1: w(",")
-        self.w_eol()
+        w, n, step = self.w, len(data), self.BYTES_PER_ROW
+        values, vstep = self.values(data), step / self.BYTES_PER_VALUE
+        for i in range(0, len(values), vstep):
+            pos = i * self.BYTES_PER_VALUE
+            w(self.row(pos, values[i:i+vstep], pos + step >= n))
+
+
+class DataWriter_c(DataWriter):
+    def row(self, pos, values, last):
+        if last:
+            return "/* 0x%04x */ %s\n" % (pos, ",".join(values))
+        return "/* 0x%04x */ %s,\n" % (pos, ",".join(values))
 
 
 class DataWriter_gas(DataWriter):
-    def w_data(self, data):
-        w, n = self.w, len(data)
-        for i in range(n):
-            if i & 15 == 0:
-                self.w_eol()
-                self.w_bol(i)
-                w(".byte ")
-            else:
-                w(",")
-            w("%3d" % ord(data[i]))
-        self.w_eol()
+    PREFIX = ".byte "
 
 
 class _DataWriter_gas_u32(DataWriter):
-    def w_data(self, data):
-        w, n = self.w, len(data)
-        assert n % 4 == 0, n
-        for i in range(0, n, 4):
-            if i & 15 == 0:
-                self.w_eol()
-                self.w_bol(i)
-                w(".int ")
-            else:
-                w(",")
-            v = struct.unpack(self.DECODE, data[i:i+4])
-            assert len(v) == 1, v
-            w("0x%08x" % (v[0] & 0xffffffffL))
-        self.w_eol()
+    BYTES_PER_VALUE = 4
+    PREFIX = ".int "
+
+    def values(self, data):
+        assert len(data) % 4 == 0, len(data)
+        words = array.array(ARRAY_U32, data)
+        if self.BYTEORDER != sys.byteorder:
+            words.byteswap()
+        return map("0x%08x".__mod__, words)
 
 class DataWriter_gas_be32(_DataWriter_gas_u32):
-    DECODE = ">i"
+    BYTEORDER = "big"
 class DataWriter_gas_le32(_DataWriter_gas_u32):
-    DECODE = "<i"
+    BYTEORDER = "little"
 
 
 class DataWriter_nasm(DataWriter):
-    def w_bol(self, pos):
-        self.pos = pos
-    def w_eol(self, fill=""):
-        if self.pos is not None:
-            self.w(fill)
-            self.w("   ; 0x%04x\n" % (self.pos))
+    def row(self, pos, values, last):
+        fill = ""
+        if last:
+            fill = " " * 4 * (self.BYTES_PER_ROW - len(values))
+        return "db %s%s   ; 0x%04x\n" % (",".join(values), fill, pos)
 
-    def w_data(self, data):
-        w, n = self.w, len(data)
-        for i in range(n):
-            if i & 15 == 0:
-                self.w_eol()
-                self.w_bol(i)
-                w("db ")
-            else:
-                w(",")
-            w("%3d" % ord(data[i]))
-        nn = ((n + 15) & ~15) - n
-        self.w_eol(" " * 4 * nn)
+
+DATA_WRITERS = {
+    "c":        DataWriter_c,
+    "gas":      DataWriter_gas,
+    "gas-be32": DataWriter_gas_be32,
+    "gas-le32": DataWriter_gas_le32,
+    "nasm":     DataWriter_nasm,
+}
 
 
 # /***********************************************************************
@@ -175,7 +189,7 @@ def w_checksum_c(w, s, data):
     w("\n")
 
 
-def write_stub(w, odata, method_index, methods):
+def write_stub(w, odata, method_index, methods, info=""):
     method = methods[method_index]
     if len(methods) > 1:
         if method_index == 0:
@@ -185,22 +199,18 @@ def write_stub(w, odata, method_index, methods):
         else:
             w("\n#else\n\n")
 
+    if info and opts.mode in ["c"] + BINARY_MODES:
+        w("/* %s */\n" % info)
     if opts.ident:
-        if opts.mode == "c":
+        if opts.mode in ["c"] + BINARY_MODES:
             w_checksum_c(w, opts.ident.upper(), odata)
+        if opts.mode == "c":
             w("unsigned char %s[%d] = {\n" % (opts.ident, len(odata)))
-    if opts.mode == "c":
-        DataWriter_c(w).w_data(odata)
-    elif opts.mode == "gas":
-        DataWriter_gas(w).w_data(odata)
-    elif opts.mode == "gas-be32":
-        DataWriter_gas_be32(w).w_data(odata)
-    elif opts.mode == "gas-le32":
-        DataWriter_gas_le32(w).w_data(odata)
-    elif opts.mode == "nasm":
-        DataWriter_nasm(w).w_data(odata)
+    if opts.mode in BINARY_MODES:
+        w_extern_c(w, binary_symbol(method, methods), odata)
     else:
-        assert 0, ("invalid mode", opts.mode)
+        assert DATA_WRITERS.has_key(opts.mode), ("invalid mode", opts.mode)
+        DATA_WRITERS[opts.mode](w).w_data(odata)
     if opts.ident:
         if opts.mode == "c":
             w("};\n")
@@ -210,6 +220,378 @@ def write_stub(w, odata, method_index, methods):
             w("\n#endif\n")
 
 
+# /***********************************************************************
+# // write binary data (--mode=incbin and --mode=obj)
+# ************************************************************************/
+
+# In the binary modes the header only declares the stub array, and the
+# data itself goes into an assembler file using .incbin (plus one raw
+# data file per compression method) or directly into an ELF object.
+# Either has to be linked into upx, but no compiler ever has to parse
+# the stub bytes.
+
+BINARY_MODES = ["incbin", "obj"]
+
+
+# the symbol of the data for one compression method
+def binary_symbol(method, methods):
+    if len(methods) == 1:
+        return opts.ident
+    return "%s_m%d" % (opts.ident, method)
+
+
+def w_extern_c(w, symbol, data):
+    if symbol != opts.ident:
+        w("#define %s %s\n" % (opts.ident, symbol))
+    w("#if defined(__cplusplus)\nextern \"C\" {\n#endif\n")
+    w("extern unsigned char %s[%d];\n" % (symbol, len(data)))
+    w("#if defined(__cplusplus)\n}\n#endif\n")
+
+
+def w_incbin_asm(w, blobs):
+    w("/* created by bin2h.py - assemble with -I set to this directory */\n\n")
+    w("#if defined(__APPLE__) || (defined(_WIN32) && !defined(_WIN64))\n")
+    w("#  define SYM(x) _##x\n#else\n#  define SYM(x) x\n#endif\n\n")
+    w(".data\n")
+    for symbol, data, datafn in blobs:
+        w("\n.globl SYM(%s)\n" % (symbol))
+        w("#if defined(__ELF__)\n")
+        w(".type SYM(%s), %%object\n.size SYM(%s), %d\n" % (symbol, symbol, len(data)))
+        w("#endif\n")
+        w("SYM(%s):\n" % (symbol))
+        w(".incbin \"%s\"\n" % (os.path.basename(datafn)))
+    w("\n#if defined(__ELF__)\n.section .note.GNU-stack,\"\",%progbits\n#endif\n")
+
+
+# bfdname: (EI_CLASS, EI_DATA, e_machine, e_flags)
+ELF_OBJ_FORMATS = {
+    "elf32-i386":          (1, 1,   3, 0),
+    "elf32-littlearm":     (1, 1,  40, 0x05000000),
+    "elf64-littleaarch64": (2, 1, 183, 0),
+    "elf64-powerpcle":     (2, 1,  21, 2),
+    "elf64-x86-64":        (2, 1,  62, 0),
+}
+
+
+# a relocatable ELF object with all blobs in .data
+def elf_object(blobs, bfdname):
+    assert ELF_OBJ_FORMATS.has_key(bfdname), ("invalid --obj-format", bfdname)
+    ei_class, ei_data, e_machine, e_flags = ELF_OBJ_FORMATS[bfdname]
+    e = ["", "<", ">"][ei_data]
+    if ei_class == 2:
+        ehdr, shdr, sym = e + "16sHHIQQQIHHHHHH", e + "IIQQQQIIQQ", e + "IBBHQQ"
+        def pack_sym(name, value, size, info, shndx):
+            return struct.pack(sym, name, info, 0, shndx, value, size)
+    else:
+        ehdr, shdr, sym = e + "16sHHIIIIIHHHHHH", e + "IIIIIIIIII", e + "IIIBBH"
+        def pack_sym(name, value, size, info, shndx):
+            return struct.pack(sym, name, value, size, info, 0, shndx)
+    # .data
+    data, symbols, strtab = "", [], "\0"
+    for symbol, blob, datafn in blobs:
+        symbols.append(pack_sym(len(strtab), len(data), len(blob), 0x11, 1)) # STB_GLOBAL, STT_OBJECT
+        strtab += symbol + "\0"
+        data += blob
+    # STN_UNDEF, then the section symbol of .data
+    symtab = pack_sym(0, 0, 0, 0, 0) + pack_sym(0, 0, 0, 0x03, 1) + "".join(symbols)
+    shstrtab = "\0.data\0.symtab\0.strtab\0.shstrtab\0.note.GNU-stack\0"
+    # layout: ehdr, .data, .symtab, .strtab, .shstrtab, section headers
+    align = lambda x, a: (x + a - 1) & -a
+    ehsize, shentsize = struct.calcsize(ehdr), struct.calcsize(shdr)
+    o_data = ehsize
+    o_symtab = align(o_data + len(data), 8)
+    o_strtab = o_symtab + len(symtab)
+    o_shstrtab = o_strtab + len(strtab)
+    e_shoff = align(o_shstrtab + len(shstrtab), 8)
+    shdrs = [
+        struct.pack(shdr, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        struct.pack(shdr, 1, 1, 3, 0, o_data, len(data), 0, 0, 1, 0),   # SHT_PROGBITS, SHF_WRITE|SHF_ALLOC
+        struct.pack(shdr, 7, 2, 0, 0, o_symtab, len(symtab), 3, 2, 8 // (3 - ei_class), struct.calcsize(sym)),
+        struct.pack(shdr, 15, 3, 0, 0, o_strtab, len(strtab), 0, 0, 1, 0),
+        struct.pack(shdr, 23, 3, 0, 0, o_shstrtab, len(shstrtab), 0, 0, 1, 0),
+        struct.pack(shdr, 33, 1, 0, 0, e_shoff, 0, 0, 0, 1, 0),       # non-executable stack
+    ]
+    e_ident = "\x7fELF" + chr(ei_class) + chr(ei_data) + "\x01"
+    h = struct.pack(ehdr, e_ident, 1, e_machine, 1, 0, 0, e_shoff, e_flags, ehsize, 0, 0, shentsize, len(shdrs), 4)
+    odata = h + data
+    odata += "\0" * (o_symtab - len(odata)) + symtab + strtab + shstrtab
+    odata += "\0" * (e_shoff - len(odata)) + "".join(shdrs)
+    return odata
+
+
+def write_binary(ofile, mdata, mdata_odata):
+    assert opts.ident, "--mode=%s needs --ident" % opts.mode
+    assert ofile != "-", "--mode=%s needs an output file" % opts.mode
+    base = re.sub(r"\.h$", "", ofile)
+    blobs = []
+    for method in mdata:
+        symbol = binary_symbol(method, mdata)
+        datafn = base + ".bin"
+        if len(mdata) > 1:
+            datafn = "%s.m%d.bin" % (base, method)
+        blobs.append((symbol, mdata_odata[method], datafn))
+    if opts.mode == "incbin":
+        ofp = outfile.OutputFile(base + ".S")
+        w_incbin_asm(ofp.write, blobs)
+        ofp.close()
+        for symbol, data, datafn in blobs:
+            outfile.write_if_changed(datafn, data)
+    elif opts.mode == "obj":
+        outfile.write_if_changed(base + ".o", elf_object(blobs, opts.obj_format))
+
+
+# /***********************************************************************
+# // raw LZMA
+# ************************************************************************/
+
+def lzma_filter(idata, lc=3, lp=0, pb=2, dict_size=None, nice_len=273):
+    if dict_size is None:
+        # no need for a dictionary larger than the stub
+        dict_size = 4096
+        while dict_size < len(idata):
+            dict_size *= 2
+    return {
+        "id": lzma.FILTER_LZMA1, "preset": 9 | lzma.PRESET_EXTREME,
+        "lc": lc, "lp": lp, "pb": pb, "dict_size": dict_size, "nice_len": nice_len,
+    }
+
+
+# A port of LzmaDecode() from the LZMA SDK 4.x as used by
+# upx_lzma_decompress() (no _LZMA_IN_CB, no _LZMA_OUT_READ): decodes
+# exactly out_len bytes from the raw stream src and returns them
+# together with the number of input bytes consumed. Like the C code it
+# only reads an input byte when it needs one, and it normalizes the
+# range coder once more after the last symbol.
+def upx_lzma_decode(src, lc, lp, pb, out_len):
+    kTopValue = 1 << 24
+    IsRep, IsRepG0, IsRepG1, IsRepG2, IsRep0Long = 192, 204, 216, 228, 240
+    PosSlot, SpecPos, Align, LenCoder, RepLenCoder, Literal = 432, 688, 802, 818, 1332, 1846
+    LenChoice, LenChoice2, LenLow, LenMid, LenHigh = 0, 1, 2, 130, 258
+    probs = [1024] * (Literal + (768 << (lc + lp)))
+    rc = [0xffffffffL, 0, 0]        # Range, Code, input position
+
+    def read_byte():
+        if rc[2] >= len(src):
+            raise Exception, "lzma data error: input exhausted"
+        c = ord(src[rc[2]])
+        rc[2] += 1
+        return c
+
+    def normalize():
+        if rc[0] < kTopValue:
+            rc[0] = (rc[0] << 8) & 0xffffffffL
+            rc[1] = ((rc[1] << 8) | read_byte()) & 0xffffffffL
+
+    def bit(i):
+        normalize()
+        bound = (rc[0] >> 11) * probs[i]
+        if rc[1] < bound:
+            rc[0] = bound
+            probs[i] += (2048 - probs[i]) >> 5
+            return 0
+        rc[0] -= bound
+        rc[1] -= bound
+        probs[i] -= probs[i] >> 5
+        return 1
+
+    def bit_tree(base, num_bits):
+        m = 1
+        for k in range(num_bits):
+            m = (m << 1) | bit(base + m)
+        return m - (1 << num_bits)
+
+    def length(base, pos_state):
+        if bit(base + LenChoice) == 0:
+            return bit_tree(base + LenLow + (pos_state << 3), 3)
+        if bit(base + LenChoice2) == 0:
+            return 8 + bit_tree(base + LenMid + (pos_state << 3), 3)
+        return 16 + bit_tree(base + LenHigh, 8)
+
+    for k in range(5):
+        rc[1] = ((rc[1] << 8) | read_byte()) & 0xffffffffL
+    out = bytearray()
+    state, rep0, rep1, rep2, rep3 = 0, 1, 1, 1, 1
+    prev = 0
+    pos_mask, lit_mask = (1 << pb) - 1, (1 << lp) - 1
+    while len(out) < out_len:
+        now = len(out)
+        pos_state = now & pos_mask
+        if bit((state << 4) + pos_state) == 0:
+            base = Literal + 768 * (((now & lit_mask) << lc) + (prev >> (8 - lc)))
+            symbol = 1
+            if state >= 7:
+                match_byte = out[now - rep0]
+                while symbol < 0x100:
+                    match_byte <<= 1
+                    mbit = match_byte & 0x100
+                    b = bit(base + 0x100 + mbit + symbol)
+                    symbol = (symbol << 1) | b
+                    if (mbit != 0) != (b != 0):
+                        break
+            while symbol < 0x100:
+                symbol = (symbol << 1) | bit(base + symbol)
+            prev = symbol & 0xff
+            out.append(prev)
+            if state < 4: state = 0
+            elif state < 10: state -= 3
+            else: state -= 6
+            continue
+        if bit(IsRep + state) == 0:
+            rep3, rep2, rep1 = rep2, rep1, rep0
+            state = (state >= 7) * 3
+            base = LenCoder
+        else:
+            if bit(IsRepG0 + state) == 0:
+                if bit(IsRep0Long + (state << 4) + pos_state) == 0:
+                    if now == 0:
+                        raise Exception, "lzma data error"
+                    state = [9, 11][state >= 7]
+                    prev = out[now - rep0]
+                    out.append(prev)
+                    continue
+            else:
+                if bit(IsRepG1 + state) == 0:
+                    distance = rep1
+                else:
+                    if bit(IsRepG2 + state) == 0:
+                        distance = rep2
+                    else:
+                        distance = rep3
+                        rep3 = rep2
+                    rep2 = rep1
+                rep1 = rep0
+                rep0 = distance
+            state = [8, 11][state >= 7]
+            base = RepLenCoder
+        n = length(base, pos_state)
+        if state < 4:
+            state += 7
+            slot = bit_tree(PosSlot + (min(n, 3) << 6), 6)
+            if slot >= 4:
+                num_direct_bits = (slot >> 1) - 1
+                rep0 = 2 | (slot & 1)
+                if slot < 14:
+                    rep0 <<= num_direct_bits
+                    base = SpecPos + rep0 - slot - 1
+                else:
+                    for k in range(num_direct_bits - 4):
+                        normalize()
+                        rc[0] >>= 1
+                        rep0 <<= 1
+                        if rc[1] >= rc[0]:
+                            rc[1] -= rc[0]
+                            rep0 |= 1
+                    base = Align
+                    rep0 <<= 4
+                    num_direct_bits = 4
+                m = 1
+                for k in range(num_direct_bits):
+                    if bit(base + m):
+                        m = (m << 1) | 1
+                        rep0 |= 1 << k
+                    else:
+                        m <<= 1
+            else:
+                rep0 = slot
+            rep0 = (rep0 + 1) & 0xffffffffL
+            if rep0 == 0:
+                # end-of-stream marker
+                break
+        n += 2
+        if rep0 > now:
+            raise Exception, "lzma data error"
+        while n > 0 and len(out) < out_len:
+            prev = out[len(out) - rep0]
+            out.append(prev)
+            n -= 1
+    normalize()
+    return str(out), rc[2]
+
+
+# The lzma module always writes an end-of-stream marker for raw LZMA1,
+# but upx_lzma_decompress() stops as soon as the output is complete and
+# then requires that all input has been consumed. So cut the stream
+# after the bytes that upx_lzma_decode() consumes.
+def lzma_trim(idata, odata, f):
+    data, n = upx_lzma_decode(odata, f["lc"], f["lp"], f["pb"], len(idata))
+    assert data == idata, "lzma round-trip failed"
+    return odata[:n]
+
+
+# Compress with the lzma module and search for the smallest output.
+# First all valid lc/lp/pb combinations are tried with the default
+# dictionary size and nice_len, then dictionary size and nice_len get
+# tuned for the best combination. The number of trials is fixed, so the
+# search time is bounded and the result is reproducible.
+def compress_lzma_raw(idata):
+    def trial(f):
+        return lzma.compress(idata, format=lzma.FORMAT_RAW, filters=[f])
+    best_f = lzma_filter(idata)
+    best = trial(best_f)
+    if opts.lzma_search:
+        candidates = []
+        for pb in range(5):
+            for lc in range(5):
+                for lp in range(5 - lc):
+                    candidates.append(lzma_filter(idata, lc, lp, pb))
+        for f in candidates:
+            odata = trial(f)
+            if len(odata) < len(best):
+                best_f, best = f, odata
+        candidates = []
+        for dict_size in [best_f["dict_size"] / 2, best_f["dict_size"] / 4]:
+            if dict_size >= 4096:
+                candidates.append(dict(best_f, dict_size=dict_size))
+        for nice_len in [16, 32, 64, 128, 192]:
+            candidates.append(dict(best_f, nice_len=nice_len))
+        for f in candidates:
+            odata = trial(f)
+            if len(odata) < len(best):
+                best_f, best = f, odata
+    odata = lzma_trim(idata, best, best_f)
+    assert upx_lzma_decode(odata, best_f["lc"], best_f["lp"], best_f["pb"], len(idata)) == (idata, len(odata))
+    info = "lzma lc=%(lc)d lp=%(lp)d pb=%(pb)d dict_size=%(dict_size)d nice_len=%(nice_len)d" % best_f
+    return best_f["lc"], best_f["lp"], best_f["pb"], odata, info
+
+
+# /***********************************************************************
+# // raw DEFLATE
+# ************************************************************************/
+
+DEFLATE_STRATEGIES = [
+    ("default",      zlib.Z_DEFAULT_STRATEGY),
+    ("filtered",     zlib.Z_FILTERED),
+    ("huffman_only", zlib.Z_HUFFMAN_ONLY),
+    ("rle",          getattr(zlib, "Z_RLE", 3)),
+    ("fixed",        getattr(zlib, "Z_FIXED", 4)),
+]
+
+
+def deflate_raw(idata, level, mem_level, wbits, strategy):
+    c = zlib.compressobj(level, zlib.DEFLATED, -wbits, mem_level, strategy)
+    return c.compress(idata) + c.flush()
+
+
+# Compress to a raw deflate stream. With opts.deflate_search try every
+# level, memLevel, window size and strategy, and keep the smallest stream
+# that inflates with a 32 KiB window. The defaults come first so that
+# they win all ties; they match the old zlib.compress(idata, 9).
+def compress_deflate_raw(idata):
+    best_p = (9, 8, 15, DEFLATE_STRATEGIES[0])
+    best = deflate_raw(idata, 9, 8, 15, zlib.Z_DEFAULT_STRATEGY)
+    if opts.deflate_search:
+        for strategy in DEFLATE_STRATEGIES:
+            for level in range(9, 0, -1):
+                for mem_level in range(9, 0, -1):
+                    for wbits in range(15, 8, -1):
+                        odata = deflate_raw(idata, level, mem_level, wbits, strategy[1])
+                        if len(odata) < len(best) and zlib.decompress(odata, -15) == idata:
+                            best_p, best = (level, mem_level, wbits, strategy), odata
+    level, mem_level, wbits, strategy = best_p
+    info = "deflate level=%d memLevel=%d wbits=-%d strategy=%s" % (level, mem_level, wbits, strategy[0])
+    return best, info
+
+
 # /***********************************************************************
 # // compress stub
 # ************************************************************************/
@@ -226,26 +608,31 @@ def encode_compressed_stub_header(method, idata, odata):
     return h
 
 
+# returns (method, odata, info) where info describes the
+# compression parameters that were used
 def compress_stub(method, idata):
     # compress
     if method == 0:
-        return 0, idata
+        return 0, idata, ""
     elif method == 14: # M_LZMA
-        import pylzma
-        odata = pylzma.compress(idata, eos=0)
-        ## FIXME: internal pylzma-0.3.0 error
-        ##assert pylzma.decompress(odata, maxlength=len(idata)) == idata
+        if lzma is not None:
+            lc, lp, pb, odata, info = compress_lzma_raw(idata)
+        else:
+            import pylzma
+            odata = pylzma.compress(idata, eos=0)
+            ## FIXME: internal pylzma-0.3.0 error
+            ##assert pylzma.decompress(odata, maxlength=len(idata)) == idata
+            prop = ord(odata[0])
+            pb = (prop / 9) / 5; lp = (prop / 9) % 5; lc = prop % 9
+            odata = odata[5:]
+            info = "pylzma lc=%d lp=%d pb=%d" % (lc, lp, pb)
         # recode lzma-header
-        prop = ord(odata[0])
-        pb = (prop / 9) / 5; lp = (prop / 9) % 5; lc = prop % 9
         h = chr(((lc + lp) << 3) | pb) + chr((lp << 4) | lc)
-        odata = h + odata[5:]
+        odata = h + odata
         # encode upx stub header
         odata = encode_compressed_stub_header(method, idata, odata) + odata
     elif method == 15: # M_DEFLATE
-        odata = zlib.compress(idata, 9)
-        # strip zlib-header and zlib-trailer (adler32)
-        odata = odata[2:-4]
+        odata, info = compress_deflate_raw(idata)
         assert zlib.decompress(odata, -15) == idata
         # encode upx stub header
         odata = encode_compressed_stub_header(method, idata, odata) + odata
@@ -253,37 +640,294 @@ def compress_stub(method, idata):
         raise Exception, ("invalid method", method, opts.methods)
     if 1 and len(odata) >= len(idata):
         # not compressible
-        return 0, idata
+        return 0, idata, ""
     assert len(odata) <= len(idata), "stub compression failed"
-    return method, odata
+    return method, odata, info
+
+
+# describe the compressor used by compress_stub(method, idata)
+def compress_params(method):
+    if method == 14: # M_LZMA
+        if lzma is not None:
+            # the stdlib lzma module goes with the Python version
+            return "%s-%s raw" % (lzma.__name__, getattr(lzma, "__version__", sys.version.split()[0]))
+        try:
+            import pylzma
+            return "pylzma-%s eos=0" % getattr(pylzma, "__version__", "?")
+        except ImportError:
+            return "pylzma"
+    elif method == 15: # M_DEFLATE
+        return "zlib-%s raw" % zlib.ZLIB_VERSION
+    return ""
 
 
 # /***********************************************************************
-# // main
+# // decompress stub and --compress=auto
 # ************************************************************************/
 
-def main(argv):
-    try: assert 0
-    except AssertionError: pass
-    else: raise Exception("fatal error - assertions not enabled")
-    shortopts, longopts = "qv", [
-        "compress=", "dry-run", "ident=", "mode=", "quiet", "verbose"
-    ]
-    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
-    for opt, optarg in xopts:
-        if 0: pass
-        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
-        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
-        elif opt in ["--compress"]: opts.methods = map(int, optarg.split(","))
-        elif opt in ["--dry-run"]: opts.dry_run = opts.dry_run + 1
-        elif opt in ["--ident"]: opts.ident = optarg
-        elif opt in ["--mode"]: opts.mode = optarg.lower()
-        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+# returns (method, u_len, c_len, header_len)
+def decode_compressed_stub_header(odata):
+    assert odata[:4] == "UPX#", "bad stub header"
+    if odata[4] == "\x00":
+        method, u_len, c_len = struct.unpack("<BII", odata[5:14])
+        return method, u_len, c_len, 14
+    method, u_len, c_len = struct.unpack("<BHH", odata[4:9])
+    return method, u_len, c_len, 9
+
+
+# the inverse of compress_stub(), as done by ElfLinker::init()
+def decompress_stub(odata):
+    if odata[:4] != "UPX#":
+        return odata
+    method, u_len, c_len, h = decode_compressed_stub_header(odata)
+    data = odata[h:h+c_len]
+    assert len(data) == c_len
+    if method == 14: # M_LZMA
+        pb, lp, lc = ord(data[0]) & 7, ord(data[1]) >> 4, ord(data[1]) & 15
+        idata, n = upx_lzma_decode(data[2:], lc, lp, pb, u_len)
+        assert n == len(data) - 2, "lzma input not consumed"
+    elif method == 15: # M_DEFLATE
+        idata = zlib.decompress(data, -15)
+    else:
+        raise Exception, ("invalid method", method)
+    assert len(idata) == u_len
+    return idata
+
+
+AUTO_METHODS = [0, 14, 15]
+
+# Decode cost in ns per uncompressed byte, from bench_bin2h.py --decode
+# (LZMA 61 MB/s, DEFLATE 387 MB/s; a stored stub is only copied).
+# --compress=auto uses these fixed numbers instead of timing the build
+# machine, so the generated header only depends on the input.
+DECODE_COST = {0: 0.25, 14: 16.4, 15: 2.6}
+
+
+# the estimated decode time of a compressed stub in ns
+def decode_cost(method, odata):
+    u_len = len(odata)
+    if odata[:4] == "UPX#":
+        u_len = decode_compressed_stub_header(odata)[1]
+    return DECODE_COST[method] * u_len
+
+
+# Pick one method out of mdata for --compress=auto. Size and decode
+# cost are both taken relative to the largest candidate, and
+# opts.auto_weight (0.0 .. 1.0) says how much decode cost counts against
+# size. Only methods on the size/cost Pareto front are considered.
+def select_auto_method(mdata, mdata_odata):
+    cand = [(len(mdata_odata[m]), decode_cost(m, mdata_odata[m]), m) for m in mdata]
+    front = [c for c in cand if not [d for d in cand if d[:2] != c[:2] and d[0] <= c[0] and d[1] <= c[1]]]
+    max_size = max([c[0] for c in cand])
+    max_cost = max([c[1] for c in cand]) or 1.0
+    w = opts.auto_weight
+    best = min([((1.0 - w) * c[0] / max_size + w * c[1] / max_cost, c[2]) for c in front])
+    return best[1]
 
-    assert len(args) == 2
-    ifile = args[0]
-    ofile = args[1]
 
+# /***********************************************************************
+# // cache of compressed stubs
+# ************************************************************************/
+
+# Compressed stubs are stored as files named by a hash of the input data,
+# the method and the compressor parameters and options. The mtime of a cache file is
+# updated on every hit, and the least recently used files get deleted
+# once the total size exceeds max_size.
+#
+# Bump CACHE_VERSION whenever compress_stub() can produce different
+# output for the same parameters (e.g. a change to lzma_trim()).
+# Every hit is decompressed again and counts as a miss if it does not
+# give back the input. The SHA-1 in front of the data also catches
+# damage that decompression cannot see, like the last LZMA byte which
+# only has to be present.
+
+CACHE_VERSION = 2
+
+class StubCache:
+    def __init__(self, dirname, max_size):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def filename(self, job):
+        method, idata, copts = job
+        h = hashlib.sha1()
+        h.update("%d\0%d\0%s\0%r\0" % (CACHE_VERSION, method, compress_params(method), copts))
+        h.update(idata)
+        return os.path.join(self.dirname, h.hexdigest())
+
+    # return the cached result of compress_job(job), or None
+    def get(self, job):
+        fn = self.filename(job)
+        try:
+            fp = open(fn, "rb")
+        except IOError:
+            self.misses += 1
+            return None
+        data = fp.read()
+        fp.close()
+        result = self.check(job, data)
+        if result is None:
+            self.misses += 1
+            return None
+        os.utime(fn, None)
+        self.hits += 1
+        return result
+
+    # decode a cache file, or return None if it is unusable
+    def check(self, job, data):
+        method, idata, copts = job
+        digest, data = data[:20], data[20:]
+        p = data.find("\n")
+        if p < 1 or hashlib.sha1(data).digest() != digest:
+            return None
+        result = ord(data[0]), data[p+1:], data[1:p]
+        try:
+            if result[0] == 0:
+                ok = result[1] == idata
+            else:
+                ok = result[0] == method and decode_compressed_stub_header(result[1])[0] == method and decompress_stub(result[1]) == idata
+        except Exception:
+            ok = False
+        if not ok:
+            return None
+        return result
+
+    def put(self, job, result):
+        fn = self.filename(job)
+        tmpfn = "%s.%d.tmp" % (fn, os.getpid())
+        fp = open(tmpfn, "wb")
+        data = chr(result[0]) + result[2] + "\n" + result[1]
+        fp.write(hashlib.sha1(data).digest() + data)
+        fp.close()
+        os.rename(tmpfn, fn)
+
+    # evict least recently used entries
+    def trim(self):
+        entries, total = [], 0
+        for f in os.listdir(self.dirname):
+            fn = os.path.join(self.dirname, f)
+            if f.endswith(".tmp") or not os.path.isfile(fn):
+                continue
+            st = os.stat(fn)
+            entries.append((st.st_mtime, fn, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for mtime, fn, size in entries:
+            if total <= self.max_size:
+                break
+            os.unlink(fn)
+            total -= size
+
+
+# /***********************************************************************
+# // compress jobs
+# ************************************************************************/
+
+# opts that affect the result of compress_stub()
+COMPRESS_OPTS = ["deflate_search", "lzma_search"]
+
+
+# a job is (method, idata, compress_opts)
+def compress_job(job):
+    method, idata, copts = job
+    for k, v in copts:
+        setattr(opts, k, v)
+    return compress_stub(method, idata)
+
+
+def timed_compress_job(job):
+    t0 = time.time()
+    result = compress_job(job)
+    return result, time.time() - t0
+
+
+# run a list of jobs, in parallel if worthwhile;
+# returns the results and the time spent per job (None if cached)
+def compress_jobs(jobs, njobs, cache=None):
+    results = [None] * len(jobs)
+    times = [None] * len(jobs)
+    # method 0 is a no-op, so only count (and cache) the real work
+    todo = []
+    for i, job in enumerate(jobs):
+        if job[0] == 0:
+            results[i], times[i] = timed_compress_job(job)
+        elif cache:
+            results[i] = cache.get(job)
+        if results[i] is None:
+            todo.append(i)
+    if njobs <= 0:
+        njobs = multiprocessing.cpu_count()
+    njobs = min(njobs, len(todo))
+    if njobs <= 1:
+        todo_results = map(timed_compress_job, [jobs[i] for i in todo])
+    else:
+        pool = multiprocessing.Pool(njobs)
+        try:
+            # Pool.map() returns the results in job order
+            todo_results = pool.map(timed_compress_job, [jobs[i] for i in todo], 1)
+        finally:
+            pool.terminate()
+    for i, (result, t) in zip(todo, todo_results):
+        results[i], times[i] = result, t
+        if cache:
+            cache.put(jobs[i], result)
+    if cache and todo:
+        cache.trim()
+    return results, times
+
+
+# jobs for all methods of one stub
+# (process in reverse order so that incompressible do not get sorted first)
+def stub_jobs(idata):
+    assert len(opts.methods) >= 1
+    r_methods = opts.methods[:]
+    r_methods.reverse()
+    copts = tuple([(k, getattr(opts, k)) for k in COMPRESS_OPTS])
+    return [(method, idata, copts) for method in r_methods]
+
+
+# merge the results of stub_jobs()
+def merge_stub_results(results):
+    mdata, mdata_odata, mdata_info = [], {}, {}
+    for method, odata, info in results:
+        if mdata_odata.has_key(method):
+            assert mdata_odata[method] == odata
+        else:
+            mdata_odata[method] = odata
+            mdata_info[method] = info
+            mdata.append(method)
+    assert len(mdata) >= 1
+    mdata.reverse()
+    ##print opts.methods, [(i, len(mdata_odata[i])) for i in mdata]
+    return mdata, mdata_odata, mdata_info
+
+
+# the --metrics record of one stub; best is the method that was
+# written, and defaults to the smallest one
+def stub_metrics(ifile, idata, mdata, mdata_odata, times, best=None):
+    sizes = dict([(m, len(mdata_odata[m])) for m in mdata])
+    smallest = min([(sizes[m], m) for m in mdata])[1]
+    if best is None:
+        best = smallest
+    return {
+        "ident": opts.ident or "", "ifile": ifile, "size": len(idata),
+        "adler32": "0x%08x" % (0xffffffffL & zlib.adler32(idata)),
+        "crc32": "0x%08x" % (0xffffffffL & zlib.crc32(idata)),
+        "methods": sizes, "best_method": best, "smallest_method": smallest,
+        "time": round(sum([t for t in times if t is not None]), 6),
+        "cached": len([t for t in times if t is None]),
+    }
+
+
+# /***********************************************************************
+# // read and write one stub
+# ************************************************************************/
+
+def read_stub(ifile):
     # check file size
     st = os.stat(ifile)
     if 1 and st.st_size <= 0:
@@ -299,8 +943,11 @@ def main(argv):
     idata = ifp.read()
     ifp.close()
     assert len(idata) == st.st_size
+    resolve_ident(ifile)
+    return ifile, idata
 
-    # opts.ident
+
+def resolve_ident(ifile):
     if opts.ident in ["auto", "auto-stub"]:
         s = os.path.basename(ifile)
         s = re.sub(r"\.(bin|out)$", "", s)
@@ -312,24 +959,16 @@ def main(argv):
         assert re.search(r"^[a-zA-Z]", opts.ident), opts.ident
         assert not re.search(r"[^a-zA-Z0-9_]", opts.ident), opts.ident
 
-    # compress stubs
-    # (process in reverse order so that incompressible do not get sorted first)
-    mdata, mdata_odata = [], {}
-    assert len(opts.methods) >= 1
-    r_methods = opts.methods[:]
-    r_methods.reverse()
-    for method in r_methods:
-        method, odata = compress_stub(method, idata)
-        if mdata_odata.has_key(method):
-            assert mdata_odata[method] == odata
-        else:
-            mdata_odata[method] = odata
-            mdata.append(method)
-    assert len(mdata) >= 1
-    mdata.reverse()
-    ##print opts.methods, [(i, len(mdata_odata[i])) for i in mdata]
 
-    # write ofile
+def w_stub_file(w, ifile, ofile, idata, mdata, mdata_odata, mdata_info):
+    if opts.verbose >= 0:
+        if opts.mode in ["c"] + BINARY_MODES:
+            w_header_c(w, ifile, ofile, len(idata))
+    for i in range(len(mdata)):
+        write_stub(w, mdata_odata[mdata[i]], i, mdata, mdata_info[mdata[i]])
+
+
+def write_file(ifile, ofile, idata, mdata, mdata_odata, mdata_info):
     if opts.dry_run:
         ofp = None
         def dummy_write(s): pass
@@ -338,18 +977,153 @@ def main(argv):
         if ofile == "-":
             ofp = sys.stdout
         else:
-            ofp = open(ofile, "wb")
+            ofp = outfile.OutputFile(ofile)
         w = ofp.write
-    if opts.verbose >= 0:
-        if opts.mode == "c":
-            w_header_c(w, ifile, ofile, len(idata))
-    for i in range(len(mdata)):
-        write_stub(w, mdata_odata[mdata[i]], i, mdata)
+    w_stub_file(w, ifile, ofile, idata, mdata, mdata_odata, mdata_info)
     if ofp:
         if ofp is sys.stdout:
             ofp.flush()
         else:
             ofp.close()
+    if opts.mode in BINARY_MODES and not opts.dry_run:
+        write_binary(ofile, mdata, mdata_odata)
+
+
+# /***********************************************************************
+# // library API
+# ************************************************************************/
+
+# Return the output of "bin2h.py ifile ofile" for the stub data idata
+# as a string. Options are given as keywords named like the opts
+# attributes (e.g. ident="auto-stub", methods=[0, 15], jobs=1); ifile
+# and ofile only end up in the header comment and in auto idents.
+# The global opts are left unchanged.
+def bin2h_data(idata, ifile="stub.bin", ofile="stub.h", cache=None, **kw):
+    saved = [(k, v) for k, v in vars(opts).items() if not k.startswith("_")]
+    try:
+        for k, v in kw.items():
+            assert hasattr(opts, k), ("invalid option", k)
+            setattr(opts, k, v)
+        if opts.compress_auto:
+            opts.methods = AUTO_METHODS[:]
+        assert opts.mode not in BINARY_MODES, "binary modes need write_file()"
+        assert len(idata) > 0
+        resolve_ident(ifile)
+        results, times = compress_jobs(stub_jobs(idata), opts.jobs, cache)
+        mdata, mdata_odata, mdata_info = merge_stub_results(results)
+        if opts.compress_auto:
+            mdata = [select_auto_method(mdata, mdata_odata)]
+        out = []
+        w_stub_file(out.append, ifile, ofile, idata, mdata, mdata_odata, mdata_info)
+        return "".join(out)
+    finally:
+        for k, v in saved:
+            setattr(opts, k, v)
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def parse_opts(argv):
+    shortopts, longopts = "j:qv", [
+        "auto-weight=", "cache-dir=", "cache-size=", "compress=", "deflate-search=", "dry-run", "ident=", "jobs=", "lzma-search=", "manifest=", "metrics=", "mode=", "obj-format=", "quiet", "verbose"
+    ]
+    xopts, args = getopt.gnu_getopt(argv, shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--cache-dir"]: opts.cache_dir = optarg
+        elif opt in ["--cache-size"]: opts.cache_size = int(optarg)
+        elif opt in ["--auto-weight"]: opts.auto_weight = float(optarg)
+        elif opt in ["--compress"]:
+            opts.compress_auto = optarg == "auto"
+            if opts.compress_auto:
+                opts.methods = AUTO_METHODS[:]
+            else:
+                opts.methods = map(int, optarg.split(","))
+        elif opt in ["--deflate-search"]: opts.deflate_search = int(optarg)
+        elif opt in ["--dry-run"]: opts.dry_run = opts.dry_run + 1
+        elif opt in ["--ident"]: opts.ident = optarg
+        elif opt in ["-j", "--jobs"]: opts.jobs = int(optarg)
+        elif opt in ["--lzma-search"]: opts.lzma_search = int(optarg)
+        elif opt in ["--manifest"]: opts.manifest = optarg
+        elif opt in ["--metrics"]: opts.metrics = optarg
+        elif opt in ["--mode"]: opts.mode = optarg.lower()
+        elif opt in ["--obj-format"]: opts.obj_format = optarg.lower()
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    return args
+
+
+# A manifest holds one stub per line: the usual bin2h.py options and
+# arguments, e.g. "--ident=auto-stub --compress=0 tmp/x.bin x.h".
+# Options given on the command line act as defaults for every line.
+def read_manifest(fn):
+    if fn == "-":
+        lines = sys.stdin.readlines()
+    else:
+        lines = open(fn, "rb").readlines()
+    entries = []
+    for l in lines:
+        l = l.strip()
+        if not l or l.startswith("#"):
+            continue
+        entries.append(shlex.split(l))
+    return entries
+
+
+def main(argv):
+    try: assert 0
+    except AssertionError: pass
+    else: raise Exception("fatal error - assertions not enabled")
+    args = parse_opts(argv[1:])
+    if opts.manifest:
+        assert not args, "no arguments allowed with --manifest"
+        entries = read_manifest(opts.manifest)
+    else:
+        # one or more "ifile ofile" pairs
+        assert len(args) >= 2 and len(args) % 2 == 0, args
+        entries = [args[i:i+2] for i in range(0, len(args), 2)]
+    njobs, verbose, metrics = opts.jobs, opts.verbose, opts.metrics
+    cache = None
+    if opts.cache_dir:
+        cache = StubCache(opts.cache_dir, opts.cache_size)
+    # read all stubs, each with a fresh copy of the global options
+    defaults = [(k, v) for k, v in vars(opts).items() if not k.startswith("_")]
+    stubs, jobs = [], []
+    for entry in entries:
+        for k, v in defaults:
+            setattr(opts, k, v)
+        args = parse_opts(entry)
+        assert len(args) == 2, ("bad manifest entry", entry)
+        ifile, idata = read_stub(args[0])
+        stub_opts = [(k, getattr(opts, k)) for k, v in defaults]
+        sjobs = stub_jobs(idata)
+        stubs.append((stub_opts, ifile, args[1], idata, len(sjobs)))
+        jobs.extend(sjobs)
+    # compress all (stub, method) combinations at once
+    results, times = compress_jobs(jobs, njobs, cache)
+    if cache and verbose >= 1:
+        print >> sys.stderr, "bin2h cache: %d hits, %d misses" % (cache.hits, cache.misses)
+    assert len(results) == len(jobs)
+    # write all stubs in order
+    records = []
+    for stub_opts, ifile, ofile, idata, n in stubs:
+        for k, v in stub_opts:
+            setattr(opts, k, v)
+        mdata, mdata_odata, mdata_info = merge_stub_results(results[:n])
+        best = None
+        if opts.compress_auto:
+            best = select_auto_method(mdata, mdata_odata)
+        records.append(stub_metrics(ifile, idata, mdata, mdata_odata, times[:n], best))
+        if best is not None:
+            mdata = [best]
+        write_file(ifile, ofile, idata, mdata, mdata_odata, mdata_info)
+        del results[:n], times[:n]
+    if metrics and not opts.dry_run:
+        stubmetrics.update_metrics(metrics, records)
+    return 0
 
 
 if __name__ == "__main__":
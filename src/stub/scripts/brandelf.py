@@ -30,6 +30,8 @@
 
 import getopt, os, re, sys
 
+import outfile
+
 
 class opts:
     bfdname = None
@@ -42,71 +44,63 @@ class opts:
 # //
 # ************************************************************************/
 
+# (bfdname, elfosabi): (EI_CLASS + EI_DATA + EI_VERSION, brand at EI_OSABI)
+BRANDS = {
+    ("elf32-bigarm",     "arm"):     ("\x01\x02\x01", "\x61"), # ELFOSABI_ARM
+    ("elf32-i386",       "freebsd"): ("\x01\x01\x01", "\x09"),
+    ("elf32-i386",       "linux"):   ("\x01\x01\x01", "\x00" * 9),
+    ("elf32-i386",       "netbsd"):  ("\x01\x01\x01", "\x02"),
+    ("elf32-i386",       "openbsd"): ("\x01\x01\x01", "\x0c"),
+    ("elf32-littlearm",  "arm"):     ("\x01\x01\x01", "\x61"), # ELFOSABI_ARM
+    ("elf32-littlemips", "linux"):   ("\x01\x01\x01", "\x00" * 9),
+    ("elf32-powerpc",    "linux"):   ("\x01\x02\x01", "\x00" * 9),
+    ("elf64-x86_64",     "linux"):   ("\x02\x01\x01", "\x00" * 9),
+    # the other ELF classes, as named by tc_bfdname in the Makefile
+    ("elf32-bigarm",     "linux"):   ("\x01\x02\x01", "\x00" * 9),
+    ("elf32-bigmips",    "linux"):   ("\x01\x02\x01", "\x00" * 9),
+    ("elf32-littlearm",  "linux"):   ("\x01\x01\x01", "\x00" * 9),
+    ("elf32-m68k",       "linux"):   ("\x01\x02\x01", "\x00" * 9),
+    ("elf64-littleaarch64", "linux"): ("\x02\x01\x01", "\x00" * 9),
+    ("elf64-powerpc",    "linux"):   ("\x02\x02\x01", "\x00" * 9),
+    ("elf64-powerpcbe",  "linux"):   ("\x02\x02\x01", "\x00" * 9),
+    ("elf64-powerpcle",  "linux"):   ("\x02\x01\x01", "\x00" * 9),
+    ("elf64-x86-64",     "linux"):   ("\x02\x01\x01", "\x00" * 9),
+}
+
+
+# return the bytes to write at EI_OSABI; fn is only used for messages
+def elf_brand(e_ident, bfdname, elfosabi, fn="<data>"):
+    if not bfdname or bfdname[:3] != "elf":
+        raise Exception, ("error: invalid args", bfdname, elfosabi)
+    if e_ident[:4] != "\x7f\x45\x4c\x46":
+        raise Exception, "%s is not %s" % (fn, "ELF")
+    if not BRANDS.has_key((bfdname, elfosabi)):
+        raise Exception, ("error: invalid args", bfdname, elfosabi)
+    ident, brand = BRANDS[(bfdname, elfosabi)]
+    if e_ident[4:7] != ident:
+        raise Exception, "%s is not %s" % (fn, bfdname)
+    return brand
+
+
+# library API: return idata with the brand applied
+def brand_data(idata, bfdname, elfosabi, fn="<data>"):
+    s = elf_brand(idata[:16], bfdname, elfosabi, fn)
+    return idata[:7] + s + idata[7+len(s):]
+
+
 def do_file(fn):
-    done = 1
     if opts.dry_run:
         fp = open(fn, "rb")
     else:
         fp = open(fn, "r+b")
     fp.seek(0, 0)
     e_ident = fp.read(16)
-    fp.seek(0, 0)
-
-    def write(s):
+    try:
+        s = elf_brand(e_ident, opts.bfdname, opts.elfosabi, fn)
         if not opts.dry_run:
-            fp.write(s)
-
-    def brand_arm(s):
-        if e_ident[4:7] != s:
-            raise Exception, "%s is not %s" % (fn, opts.bfdname)
-        write("\x61") # ELFOSABI_ARM
-    def brand_freebsd(s):
-        if e_ident[4:7] != s:
-            raise Exception, "%s is not %s" % (fn, opts.bfdname)
-        write("\x09")
-    def brand_linux(s):
-        if e_ident[4:7] != s:
-            raise Exception, "%s is not %s" % (fn, opts.bfdname)
-        ##write("\x00Linux\x00\x00\x00")
-        write("\x00" * 9)
-    def brand_netbsd(s):
-        if e_ident[4:7] != s:
-            raise Exception, "%s is not %s" % (fn, opts.bfdname)
-        write("\x02")
-    def brand_openbsd(s):
-        if e_ident[4:7] != s:
-            raise Exception, "%s is not %s" % (fn, opts.bfdname)
-        write("\x0c")
-
-    if opts.bfdname[:3] == "elf":
-        if e_ident[:4] != "\x7f\x45\x4c\x46":
-            raise Exception, "%s is not %s" % (fn, "ELF")
-        fp.seek(7, 0)
-        if opts.bfdname == "elf32-bigarm" and opts.elfosabi == "arm":
-            brand_arm("\x01\x02\x01")
-        elif opts.bfdname == "elf32-i386" and opts.elfosabi == "freebsd":
-            brand_freebsd("\x01\x01\x01")
-        elif opts.bfdname == "elf32-i386" and opts.elfosabi == "linux":
-            brand_linux("\x01\x01\x01")
-        elif opts.bfdname == "elf32-i386" and opts.elfosabi == "netbsd":
-            brand_netbsd("\x01\x01\x01")
-        elif opts.bfdname == "elf32-i386" and opts.elfosabi == "openbsd":
-            brand_openbsd("\x01\x01\x01")
-        elif opts.bfdname == "elf32-littlearm" and opts.elfosabi == "arm":
-            brand_arm("\x01\x01\x01")
-        elif opts.bfdname == "elf32-littlemips" and opts.elfosabi == "linux":
-            brand_linux("\x01\x01\x01")
-        elif opts.bfdname == "elf32-powerpc" and opts.elfosabi == "linux":
-            brand_linux("\x01\x02\x01")
-        elif opts.bfdname == "elf64-x86_64" and opts.elfosabi == "linux":
-            brand_linux("\x02\x01\x01")
-        else:
-            done = 0
-    else:
-        done = 0
-    fp.close()
-    if not done:
-        raise Exception, ("error: invalid args", opts.__dict__)
+            outfile.patch_if_changed(fp, 7, s)
+    finally:
+        fp.close()
 
 
 def main(argv):
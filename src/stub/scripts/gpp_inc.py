@@ -28,15 +28,21 @@
 #
 
 
-import getopt, os, re, sys
+import cStringIO, getopt, hashlib, json, os, re, sys
+
+import outfile
 
 
 class opts:
+    depdb = None
+    deps_only = 0
     dry_run = 0
     verbose = 0
     fatal = 1
     includes = []
+    jobs = 1
     mode = "c"
+    target_md = None
     target_mf = None
     target_mmd = None
 
@@ -44,6 +50,30 @@ class opts:
 files_md = []
 files_mmd = []
 files_st = {}
+files_md5 = {}
+
+# per-run caches: os.path.isfile() results (negative ones too), and the
+# expansion of every file already handled
+isfile_cache = {}
+text_cache = {}
+stats = {}
+
+def reset_stats():
+    for k in ["isfile", "isfile_cached", "read", "reused", "reused_bytes"]:
+        stats[k] = 0
+
+reset_stats()
+
+
+def cached_isfile(fn):
+    r = isfile_cache.get(fn)
+    if r is None:
+        stats["isfile"] += 1
+        r = isfile_cache[fn] = os.path.isfile(fn)
+    else:
+        stats["isfile_cached"] += 1
+    return r
+
 
 def add_dep(state, fn, mode):
     if mode:
@@ -64,7 +94,7 @@ def not_found(state, l, inc, fatal=None):
         fatal = opts.fatal
     if fatal:
         raise Exception, "%s:%d: include file %s not found" % (state[0], state[2], inc)
-    return l
+    return None
 
 
 def parse_comment(state, l, comment):
@@ -82,10 +112,18 @@ def parse_comment(state, l, comment):
     return cf
 
 
-def handle_inc_c(state, l, ofp):
-    m = re.search(r"^\s*\#\s*include\s+([\"\<])(.+?)([\"\>])(.*)$", l)
-    if not m:
-        return l
+# The include lines of a whole file buffer; [^\S\n] is \s without the
+# newline, so a match never leaves its line.
+INCLUDE_RE = {
+    "c":    re.compile(r"^[^\S\n]*\#[^\S\n]*include[^\S\n]+([\"\<])(.+?)([\"\>])(.*)$", re.M),
+    "nasm": re.compile(r"^[^\S\n]*\%[^\S\n]*include[^\S\n]+([\"\<])(.+?)([\"\>])(.*)$", re.M),
+}
+
+
+# resolve_inc_*() return (file, included with <>) for an include line,
+# or None to keep the line as it is
+def resolve_inc_c(state, m):
+    l = m.group(0)
     q1, inc, q2, comment = m.groups()
     cf = parse_comment(state, l, comment)
     if q1 == '<' and q2 == '>':
@@ -96,17 +134,13 @@ def handle_inc_c(state, l, ofp):
         raise Exception, "syntax error: include line " + l
     for dir in dirs:
         fn = os.path.join(dir, inc)
-        if os.path.isfile(fn):
-            add_dep(state, fn, q1 == '<')
-            handle_file(fn, ofp, state)
-            return None
+        if cached_isfile(fn):
+            return fn, q1 == '<'
     return not_found(state, l, inc, cf.get("fatal"))
 
 
-def handle_inc_nasm(state, l, ofp):
-    m = re.search(r"^\s*\%\s*include\s+([\"\<])(.+?)([\"\>])(.*)$", l)
-    if not m:
-        return l
+def resolve_inc_nasm(state, m):
+    l = m.group(0)
     q1, inc, q2, comment = m.groups()
     cf = parse_comment(state, l, comment)
     if q1 == '<' and q2 == '>':
@@ -118,25 +152,316 @@ def handle_inc_nasm(state, l, ofp):
     # info: nasm simply does concat the includes
     for prefix in opts.includes + [""]:
         fn = prefix + inc
-        if os.path.isfile(fn):
-            add_dep(state, fn, False)
-            handle_file(fn, ofp, state)
-            return None
+        if cached_isfile(fn):
+            return fn, False
     return not_found(state, l, inc, cf.get("fatal"))
 
 
-def handle_file(ifn, ofp, parent_state=None):
-    state = [ifn, os.path.dirname(ifn) or ".", 0, parent_state]
+RESOLVE_INC = {"c": resolve_inc_c, "nasm": resolve_inc_nasm}
+
+
+# The matches of the include lines of a file, in file order. Only the
+# lines containing "include" are matched at all; str.find() skips over
+# the others much faster than the regex engine.
+def include_lines(state, data):
+    r = INCLUDE_RE.get(opts.mode)
+    if r is None:
+        return
+    lpos = 0
+    p = data.find("include")
+    while p >= 0:
+        bol = data.rfind("\n", 0, p) + 1
+        m = r.match(data, bol)
+        if m:
+            # line counter, for the error messages
+            state[2] += data.count("\n", lpos, bol)
+            lpos = bol
+            yield m
+        eol = data.find("\n", p)
+        if eol < 0:
+            break
+        p = data.find("include", eol)
+
+
+def read_file(ifn):
     ifp = open(ifn, "rb")
-    for l in ifp.readlines():
-        state[2] += 1       # line counter
-        l = l.rstrip("\n")
-        if opts.mode == "c":
-            l = handle_inc_c(state, l, ofp)
-        elif opts.mode == "nasm":
-            l = handle_inc_nasm(state, l, ofp)
-        if l is not None:
-            ofp.write(l + "\n")
+    data = ifp.read()
+    ifp.close()
+    files_md5[os.path.normcase(os.path.normpath(ifn))] = hashlib.md5(data).hexdigest()
+    return data
+
+
+# The expansion of ifn as a list of string chunks: the unchanged spans
+# of the file and the chunks of its includes, which are spliced in
+# without copying. The expansion only depends on the file and the
+# (fixed) options, so a file included again comes from the cache.
+def file_chunks(ifn, parent_state=None):
+    r = text_cache.get(ifn)
+    if r is not None:
+        stats["reused"] += 1
+        stats["reused_bytes"] += r[1]
+        return r[0]
+    stats["read"] += 1
+    data = read_file(ifn)
+    # every line ends with a newline in the output
+    if data and data[-1] != "\n":
+        data += "\n"
+    state = [ifn, os.path.dirname(ifn) or ".", 1, parent_state]
+    chunks, pos = [], 0
+    for m in include_lines(state, data):
+        r = RESOLVE_INC[opts.mode](state, m)
+        if r is None:
+            continue
+        add_dep(state, r[0], r[1])
+        if pos < m.start():
+            chunks.append(data[pos:m.start()])
+        chunks.extend(file_chunks(r[0], state))
+        # drop the include line and its newline
+        pos = m.end() + 1
+    if pos < len(data):
+        chunks.append(data[pos:])
+    text_cache[ifn] = (chunks, sum(map(len, chunks)))
+    return chunks
+
+
+def handle_file(ifn, ofp, parent_state=None):
+    ofp.writelines(file_chunks(ifn, parent_state))
+
+
+# /***********************************************************************
+# // dependency scan
+# ************************************************************************/
+
+# The includes of ifn without expanding anything: a list of
+# (file, included with <>) or None (not found, not fatal) for its
+# include lines; an exception ends the list. If ifn itself cannot be
+# read the exception is returned instead of the list.
+def scan_file(ifn):
+    try:
+        data = read_file(ifn)
+    except EnvironmentError, e:
+        return e
+    state = [ifn, os.path.dirname(ifn) or ".", 1, None]
+    incs = []
+    for m in include_lines(state, data):
+        try:
+            incs.append(RESOLVE_INC[opts.mode](state, m))
+        except Exception, e:
+            incs.append(e)
+            break
+    return incs
+
+
+# Scan the include graph breadth-first; the files of each level are
+# independent, so they are read and scanned concurrently. Each file is
+# scanned once.
+def scan_graph(ifn, jobs):
+    scans = {}
+    pool = None
+    try:
+        level = [ifn]
+        while level:
+            if jobs > 1 and len(level) > 1:
+                if pool is None:
+                    from multiprocessing.pool import ThreadPool
+                    pool = ThreadPool(jobs)
+                results = pool.map(scan_file, level)
+            else:
+                results = map(scan_file, level)
+            next_level = []
+            for fn, incs in zip(level, results):
+                scans[fn] = incs
+                if isinstance(incs, Exception):
+                    continue
+                for inc in incs:
+                    if isinstance(inc, tuple) and not scans.has_key(inc[0]) and inc[0] not in next_level:
+                        next_level.append(inc[0])
+            level = [fn for fn in next_level if not scans.has_key(fn)]
+    finally:
+        if pool is not None:
+            pool.close()
+    return scans
+
+
+# Walk the scanned graph in include order, so the dependencies and the
+# first error come out exactly as in a full expansion.
+def visit_scans(ifn, scans, visited):
+    visited[ifn] = 1
+    incs = scans[ifn]
+    if isinstance(incs, Exception):
+        raise incs
+    for inc in incs:
+        if isinstance(inc, Exception):
+            raise inc
+        if inc is None:
+            continue
+        add_dep(None, inc[0], inc[1])
+        if not visited.has_key(inc[0]):
+            visit_scans(inc[0], scans, visited)
+
+
+# /***********************************************************************
+# // library API
+# ************************************************************************/
+
+# run f(ifn) with fresh per-run state; returns the dict from f plus the
+# files included with <> and "" (for -MD and -MMD), the signatures of
+# ifn and all its includes, and the include candidates that did not exist
+def run_file(f, ifn, includes, mode, fatal):
+    global files_md, files_mmd, files_st, files_md5, isfile_cache, text_cache
+    saved = (opts.includes, opts.mode, opts.fatal,
+             files_md, files_mmd, files_st, files_md5, isfile_cache, text_cache)
+    opts.includes, opts.mode, opts.fatal = list(includes), mode, fatal
+    files_md, files_mmd, files_st, files_md5, isfile_cache, text_cache = [], [], {}, {}, {}, {}
+    reset_stats()
+    try:
+        top = os.path.normcase(os.path.normpath(ifn))
+        files_st[top] = os.stat(ifn)
+        r = f(ifn)
+        sigs = {}
+        for fn, st in files_st.items():
+            sigs[fn] = [st.st_mtime, st.st_size, files_md5[fn]]
+        missing = sorted([fn for fn, ok in isfile_cache.items() if not ok])
+        r.update({"md": files_md, "mmd": files_mmd, "files": sigs, "missing": missing})
+        return r
+    finally:
+        (opts.includes, opts.mode, opts.fatal,
+         files_md, files_mmd, files_st, files_md5, isfile_cache, text_cache) = saved
+
+
+# preprocess ifn; the dict also has the text
+def expand(ifn, includes=[], mode="c", fatal=1):
+    def f(ifn):
+        ofp = cStringIO.StringIO()
+        handle_file(ifn, ofp)
+        return {"text": ofp.getvalue()}
+    return run_file(f, ifn, includes, mode, fatal)
+
+
+# the dependencies of ifn only; the dict also has the number of files
+# scanned
+def scan_deps(ifn, includes=[], mode="c", fatal=1, jobs=1):
+    def f(ifn):
+        scans = scan_graph(ifn, jobs)
+        visit_scans(ifn, scans, {})
+        return {"scanned": len(scans)}
+    return run_file(f, ifn, includes, mode, fatal)
+
+
+# return the preprocessed text of ifn and the list of files included
+# with "" (for -MMD)
+def preprocess(ifn, includes=[], mode="c", fatal=1):
+    r = expand(ifn, includes, mode, fatal)
+    return r["text"], r["mmd"]
+
+
+# /***********************************************************************
+# // dependency database
+# ************************************************************************/
+
+# A JSON file with one entry per run (cwd, input, output, mode, include
+# path): the [mtime, size, md5] of the input, of everything it included
+# and of this script, the include candidates that did not exist, the
+# dependency lists and the [mtime, size] of the output. If no file of
+# the closure changed (a new mtime with the old contents does not
+# count), no missing candidate appeared and the output is unchanged,
+# the expansion is skipped and the .d file is written from the entry.
+# Several runs may share one database; updates are serialized with a
+# lock file.
+
+def file_md5(fn):
+    fp = open(fn, "rb")
+    h = hashlib.md5(fp.read()).hexdigest()
+    fp.close()
+    return h
+
+
+def depdb_key(ifile, ofile):
+    return json.dumps([os.getcwd(), ifile, ofile, opts.mode, opts.includes, opts.fatal])
+
+
+def depdb_read(fn):
+    try:
+        return json.load(open(fn, "rb"))
+    except (IOError, ValueError):
+        return {}
+
+
+def depdb_update(fn, key, entry):
+    import fcntl
+    lfp = open(fn + ".lock", "wb")
+    try:
+        fcntl.lockf(lfp, fcntl.LOCK_EX)
+        db = depdb_read(fn)
+        db[key] = entry
+        outfile.write_if_changed(fn, json.dumps(db, indent=1, separators=(",", ": "), sort_keys=True) + "\n")
+    finally:
+        lfp.close()
+
+
+def output_signature(ofile):
+    if ofile is None:
+        return []           # --deps-only
+    if not os.path.exists(ofile):
+        return None
+    st = os.stat(ofile)
+    if not os.path.isfile(ofile):
+        return []           # e.g. /dev/null
+    return [st.st_mtime, st.st_size]
+
+
+def script_file():
+    fn = os.path.abspath(__file__)
+    if fn.endswith(".pyc") or fn.endswith(".pyo"):
+        fn = fn[:-1]
+    return fn
+
+
+# return the entry if it is up to date (refreshing touched files), else None
+def depdb_lookup(fn, key, ofile):
+    entry = depdb_read(fn).get(key)
+    if entry is None or output_signature(ofile) != entry["output"]:
+        return None
+    touched = 0
+    for f, sig in entry["files"].items():
+        try:
+            st = os.stat(f)
+        except OSError:
+            return None
+        if [st.st_mtime, st.st_size] == sig[:2]:
+            continue
+        if st.st_size != sig[1] or file_md5(f) != sig[2]:
+            return None
+        sig[0] = st.st_mtime
+        touched += 1
+    for f in entry["missing"]:
+        if os.path.isfile(f):
+            return None
+    if touched:
+        depdb_update(fn, key, entry)
+    return entry
+
+
+def depdb_entry(r, ofile):
+    files = dict(r["files"])
+    script = script_file()
+    st = os.stat(script)
+    files[script] = [st.st_mtime, st.st_size, file_md5(script)]
+    return {"files": files, "missing": r["missing"], "md": r["md"], "mmd": r["mmd"],
+            "output": output_signature(ofile)}
+
+
+# the contents of a .d file, or None if there are no dependencies
+def format_deps(target, deps):
+    if not deps:
+        return None
+    s = "%s : \\\n" % target
+    for i, f in enumerate(deps):
+        if i < len(deps) - 1:
+            s += "  %s \\\n" % f
+        else:
+            s += "  %s\n" % f
+    return s
 
 
 def main(argv):
@@ -144,7 +469,7 @@ def main(argv):
     except AssertionError: pass
     else: raise Exception("fatal error - assertions not enabled")
     ofile = None
-    shortopts, longopts = "qvI:o:", ["dry-run", "MF=", "MMD=", "mode=", "quiet", "verbose"]
+    shortopts, longopts = "qvI:o:", ["depdb=", "deps-only", "dry-run", "jobs=", "MD=", "MF=", "MMD=", "mode=", "quiet", "verbose"]
     xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
     for opt, optarg in xopts:
         if 0: pass
@@ -154,11 +479,20 @@ def main(argv):
         elif opt in ["-I"]: opts.includes.append(optarg)
         elif opt in ["-o"]: ofile = optarg
         elif opt in ["--mode"]: opts.mode = optarg.lower()
+        elif opt in ["--depdb"]: opts.depdb = optarg
+        elif opt in ["--deps-only"]: opts.deps_only = opts.deps_only + 1
+        elif opt in ["--jobs"]: opts.jobs = int(optarg)
+        elif opt in ["--MD"]: opts.target_md = optarg
         elif opt in ["--MF"]: opts.target_mf = optarg
         elif opt in ["--MMD"]: opts.target_mmd = optarg
         else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
 
-    if ofile is None:
+    if opts.deps_only:
+        # only the .d file is written
+        assert ofile is None and len(args) == 1
+        assert opts.target_mf and (opts.target_md or opts.target_mmd), "--deps-only needs --MF and --MD or --MMD"
+        ifile = args[0]
+    elif ofile is None:
         assert len(args) == 2
         ifile = args[0]
         ofile = args[1]
@@ -167,25 +501,40 @@ def main(argv):
         ifile = args[0]
 
     assert os.path.isfile(ifile)
-    ofp = open(ofile, "wb")
-    handle_file(ifile, ofp)
-    ofp.close()
-
-    if opts.target_mmd:
-        fn = ofile + ".d"
-        if opts.target_mf:
-            fn = opts.target_mf
-        if os.path.isfile(fn):
+    assert not (opts.target_md and opts.target_mmd), "--MD and --MMD are exclusive"
+    entry = None
+    if opts.depdb:
+        key = depdb_key(ifile, ofile)
+        entry = depdb_lookup(opts.depdb, key, ofile)
+        if entry is not None and opts.verbose >= 1:
+            print >> sys.stderr, "%s: up to date (%d files checked)" % (ifile, len(entry["files"]))
+    if entry is None:
+        if opts.deps_only:
+            r = scan_deps(ifile, opts.includes, opts.mode, opts.fatal, opts.jobs)
+            if opts.verbose >= 1:
+                print >> sys.stderr, "%s: %d files scanned, %d dependencies" % (ifile, r["scanned"], len(r["md"]) + len(r["mmd"]))
+        else:
+            r = expand(ifile, opts.includes, opts.mode, opts.fatal)
+            if opts.verbose >= 1:
+                print >> sys.stderr, "%s: %d files read, %d includes from the cache (%d bytes); %d isfile calls, %d avoided" % (
+                    ifile, stats["read"], stats["reused"], stats["reused_bytes"], stats["isfile"], stats["isfile_cached"])
+            outfile.write_if_changed(ofile, r["text"])
+        entry = r
+        if opts.depdb:
+            entry = depdb_entry(r, ofile)
+            depdb_update(opts.depdb, key, entry)
+
+    target, deps = opts.target_mmd, entry["mmd"]
+    if opts.target_md:
+        # like gcc -MD: the system includes too
+        target, deps = opts.target_md, entry["mmd"] + [f for f in entry["md"] if f not in entry["mmd"]]
+    if target:
+        fn = opts.target_mf or ofile + ".d"
+        d = format_deps(target, deps)
+        if d is not None:
+            outfile.write_if_changed(fn, d)
+        elif os.path.isfile(fn):
             os.unlink(fn)
-        if files_mmd:
-            fp = open(fn, "wb")
-            fp.write("%s : \\\n" % opts.target_mmd)
-            for i, f in enumerate(files_mmd):
-                if i < len(files_mmd) - 1:
-                    fp.write("  %s \\\n" % f)
-                else:
-                    fp.write("  %s\n" % f)
-            fp.close()
 
 
 if __name__ == "__main__":
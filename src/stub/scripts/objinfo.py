@@ -0,0 +1,439 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  objinfo.py -- convert the objdump link info to the format ElfLinker reads
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage:
+#   objinfo.py [--format=bin|text|text-min] [GC-OPTIONS] tmp/T.bin.dump tmp/T.bin
+#
+# appends the link info from the "objdump -htr" dump to the stripped
+# object. "text" appends the dump itself, which ElfLinker::init() has to
+# parse on every run. "text-min" appends a dump that has only the rows
+# and fields ElfLinker::preprocess*() reads: no headers, no VMA/LMA
+# or flags columns, no leading zeros and no "OFFSET TYPE VALUE" lines.
+# "bin" (the default) appends a binary table that ElfLinker loads
+# without any text parsing:
+#
+#   header      "UPXO", version, nsections, nsymbols, nrelocations,
+#               strings size
+#   sections    name, offset, size, p2align
+#   symbols     name, section, offset
+#   relocations section, offset, type, symbol, add (low, high)
+#   index       the sections (nsections + 2 entries) sorted by name
+#   index       the symbols (nsymbols entries) sorted by name
+#   strings     NUL terminated
+#   trailer     header offset, "UPXO"
+#
+# All fields are LE32; names and types are offsets into the strings,
+# sections and symbols are indices. The sections "*ABS*" and "*UND*"
+# are not stored - ElfLinker adds them after the others, so they have
+# the indices nsections and nsections + 1. ElfLinker::findSection()
+# and findSymbol() do a binary search in the two name indices.
+#
+# With --gc-roots=FILE (names separated by blanks, commas or newlines)
+# or --gc-sources=GLOB (every word in the string literals of the C++
+# sources) the sections that the packers cannot reach are dropped from
+# a "bin" or "text-min" link info: a section is kept if it or one of
+# its symbols is a root, or if a kept section has a relocation against
+# one of its symbols. The contents of the dropped sections are removed
+# from the object as well. Of the remaining symbols only the roots and
+# the targets of relocations are kept - no other symbol can ever be
+# looked up. A report line with the savings is printed per stub;
+# --dry-run prints the report without changing the file.
+#
+
+
+import getopt, glob, re, struct, sys
+
+import xstrip
+
+
+class opts:
+    dry_run = 0
+    format = "bin"
+    gc_roots = []
+    gc_sources = []
+    verbose = 0
+
+
+OBJINFO_MAGIC = "UPXO"
+OBJINFO_VERSION = 2
+OBJINFO_FORMATS = ["bin", "text", "text-min"]
+
+
+# /***********************************************************************
+# // parse the dump the same way as ElfLinker::preprocess*()
+# ************************************************************************/
+
+# returns (sections, symbols, relocations):
+#   sections     [(name, offset, size, p2align)]
+#   symbols      [(name, section name, offset)]
+#   relocations  [(section name, offset, type, symbol name, add)]
+def parse_dump(dump):
+    psections = dump.find("Sections:\n")
+    psymbols = dump.find("SYMBOL TABLE:\n", psections)
+    prelocs = dump.find("RELOCATION RECORDS FOR ", psymbols)
+    assert 0 <= psections < psymbols < prelocs
+    sections, section_names = [], {}
+    for l in dump[psections:psymbols].split("\n"):
+        m = re.search(r"^\s*[-+]?\d+\s+(\S+)\s+([0-9a-fA-F]+)\s+[-+]?\d+\s+[-+]?\d+\s+([0-9a-fA-F]+)\s+2\*\*(\d+)", l)
+        if m:
+            name = m.group(1)
+            assert not section_names.has_key(name), ("duplicate section", name)
+            section_names[name] = 1
+            sections.append((name, int(m.group(3), 16), int(m.group(2), 16), int(m.group(4))))
+    for name in ["*ABS*", "*UND*"]:
+        assert not section_names.has_key(name), ("duplicate section", name)
+        section_names[name] = 1
+    symbols, symbol_names = [], {}
+    for l in dump[psymbols:prelocs].split("\n"):
+        m = re.search(r"^\s*([0-9a-fA-F]+)\s*g\s*\*ABS\*\s*([0-9a-fA-F]+)\s*(\S+)", l)
+        if m:
+            assert int(m.group(2), 16) == 0, l
+            e = (m.group(3), "*ABS*", int(m.group(1), 16) & 0xffffffffL)
+        else:
+            m = re.search(r"^\s*([0-9a-fA-F]+)(?![0-9a-fA-F]).{8}\s*(\S+)\s+[0-9a-fA-F]+\s+(\S+)", l)
+            if not m:
+                continue
+            offset = int(m.group(1), 16) & 0xffffffffL
+            if m.group(2) == "*UND*":
+                offset = 0xdeaddeadL
+            assert m.group(2) != "*ABS*", l
+            e = (m.group(3), m.group(2), offset)
+        assert section_names.has_key(e[1]), ("unknown section", e)
+        assert not symbol_names.has_key(e[0]), ("duplicate symbol", e)
+        symbol_names[e[0]] = 1
+        symbols.append(e)
+    relocations = []
+    section = None
+    for l in dump[prelocs:].split("\n"):
+        m = re.search(r"^RELOCATION RECORDS FOR \[([^]]+)", l)
+        if m:
+            section = m.group(1)
+            assert section_names.has_key(section), ("unknown section", section)
+        m = re.search(r"^\s*([0-9a-fA-F]+)\s+(\S+)\s+(\S+)", l)
+        if not m or section is None:
+            continue
+        symbol, add = m.group(3), 0
+        p = symbol.find("+0x")
+        if p < 0:
+            p = symbol.find("-0x")
+        if p >= 0:
+            assert len(symbol) - p - 3 in [8, 16], l
+            add = int(symbol[p+3:], 16)
+            if symbol[p] == "-":
+                add = -add & 0xffffffffffffffffL
+            symbol = symbol[:p]
+        assert symbol_names.has_key(symbol), ("unknown symbol", symbol)
+        relocations.append((section, int(m.group(1), 16) & 0xffffffffL, m.group(2), symbol, add))
+    return sections, symbols, relocations
+
+
+# /***********************************************************************
+# // binary format
+# ************************************************************************/
+
+HEADER = struct.Struct("<4sIIIII")
+SECTION = struct.Struct("<IIII")
+SYMBOL = struct.Struct("<III")
+RELOCATION = struct.Struct("<IIIIII")
+INDEX = struct.Struct("<I")
+TRAILER = struct.Struct("<I4s")
+
+
+# base is the size of the data the table gets appended to
+def pack_objinfo(info, base):
+    sections, symbols, relocations = info
+    strings, string_pos = ["\0"], {"": 0}
+    def string(s):
+        if not string_pos.has_key(s):
+            string_pos[s] = sum(map(len, strings))
+            strings.append(s + "\0")
+        return string_pos[s]
+    section_names = [s[0] for s in sections] + ["*ABS*", "*UND*"]
+    section_index = dict([(name, i) for i, name in enumerate(section_names)])
+    symbol_index = dict([(s[0], i) for i, s in enumerate(symbols)])
+    out = []
+    for name, offset, size, p2align in sections:
+        out.append(SECTION.pack(string(name), offset, size, p2align))
+    for name, section, offset in symbols:
+        out.append(SYMBOL.pack(string(name), section_index[section], offset))
+    for section, offset, type, symbol, add in relocations:
+        out.append(RELOCATION.pack(section_index[section], offset, string(type),
+                                   symbol_index[symbol], add & 0xffffffffL, add >> 32))
+    # strcmp() order
+    for names in [section_names, [s[0] for s in symbols]]:
+        for i in sorted(range(len(names)), key=lambda i: names[i]):
+            out.append(INDEX.pack(i))
+    strings = "".join(strings)
+    header = HEADER.pack(OBJINFO_MAGIC, OBJINFO_VERSION, len(sections), len(symbols), len(relocations), len(strings))
+    return header + "".join(out) + strings + TRAILER.pack(base, OBJINFO_MAGIC)
+
+
+# the inverse of pack_objinfo(); returns (info, base) or None
+def unpack_objinfo(data):
+    if len(data) < HEADER.size + TRAILER.size:
+        return None
+    base, magic = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+    if magic != OBJINFO_MAGIC:
+        return None
+    magic, version, nsections, nsymbols, nrelocations, strings_size = HEADER.unpack_from(data, base)
+    assert magic == OBJINFO_MAGIC and version == OBJINFO_VERSION
+    pos = base + HEADER.size
+    def get(st, n):
+        l = [st.unpack_from(data, pos + i * st.size) for i in range(n)]
+        return l, pos + n * st.size
+    s, pos = get(SECTION, nsections)
+    y, pos = get(SYMBOL, nsymbols)
+    r, pos = get(RELOCATION, nrelocations)
+    section_index, pos = get(INDEX, nsections + 2)
+    symbol_index, pos = get(INDEX, nsymbols)
+    assert pos + strings_size + TRAILER.size == len(data)
+    strings = data[pos:pos+strings_size]
+    def string(i):
+        return strings[i:strings.index("\0", i)]
+    names = [string(e[0]) for e in s] + ["*ABS*", "*UND*"]
+    sections = [(string(e[0]), e[1], e[2], e[3]) for e in s]
+    symbols = [(string(e[0]), names[e[1]], e[2]) for e in y]
+    relocations = [(names[e[0]], e[1], string(e[2]), symbols[e[3]][0], e[4] | (e[5] << 32)) for e in r]
+    for index, names in [(section_index, names), (symbol_index, [e[0] for e in symbols])]:
+        index = [names[e[0]] for e in index]
+        assert index == sorted(names), "bad name index"
+    return (sections, symbols, relocations), base
+
+
+# /***********************************************************************
+# // minimal text format
+# ************************************************************************/
+
+# the shortest dump that parse_dump() and ElfLinker::preprocess*() read
+# as info; the section index and the 8 flag characters of a symbol line
+# are skipped by the sscanf() formats, the rest are the fields proper
+def format_dump(info):
+    sections, symbols, relocations = info
+    out = ["Sections:\n"]
+    for name, offset, size, p2align in sections:
+        out.append("0 %s %x 0 0 %x 2**%d\n" % (name, size, offset, p2align))
+    out.append("SYMBOL TABLE:\n")
+    for name, section, offset in symbols:
+        if section == "*ABS*":
+            out.append("%x g *ABS* 0 %s\n" % (offset, name))
+        elif section == "*UND*":
+            out.append("0         *UND* 0 %s\n" % name)
+        else:
+            out.append("%x         %s 0 %s\n" % (offset, section, name))
+    section = None
+    for r in relocations:
+        if r[0] != section:
+            section = r[0]
+            out.append("RELOCATION RECORDS FOR [%s]:\n" % section)
+        offset, type, symbol, add = r[1:]
+        if add > 0xffffffffL:
+            symbol += "+0x%016x" % add
+        elif add:
+            symbol += "+0x%08x" % add
+        out.append("%x %s %s\n" % (offset, type, symbol))
+    if section is None:
+        out.append("RELOCATION RECORDS FOR [*UND*]:\n")
+    return "".join(out)
+
+
+# /***********************************************************************
+# // unreachable section removal
+# ************************************************************************/
+
+def read_roots(fn):
+    roots = {}
+    for l in open(fn, "rb").read().splitlines():
+        for name in re.split(r"[\s,]+", re.sub(r"#.*", "", l)):
+            if name:
+                roots[name] = 1
+    return roots
+
+
+# all words in the string literals of C/C++ sources, e.g. the section
+# names passed to addLoader(), getSection() and defineSymbol()
+def source_roots(fns):
+    roots = {}
+    for fn in fns:
+        src = open(fn, "rb").read()
+        for s in re.findall(r'"((?:[^"\\\n]|\\.)*)"', src):
+            for name in re.split(r"[\s,]+", s):
+                if name:
+                    roots[name] = 1
+    return roots
+
+
+# the roots for --gc-roots=FILE... and --gc-sources=GLOB..., or None
+def gc_roots(roots_fns, source_patterns):
+    if not roots_fns and not source_patterns:
+        return None
+    roots = {}
+    for fn in roots_fns:
+        roots.update(read_roots(fn))
+    fns = []
+    for pattern in source_patterns:
+        fns += sorted(glob.glob(pattern))
+    if source_patterns and not fns:
+        raise Exception, "error: --gc-sources: no files"
+    roots.update(source_roots(fns))
+    return roots
+
+
+# returns (info without the unreachable sections, dropped section names)
+def gc_sections(info, roots):
+    sections, symbols, relocations = info
+    symbol_section = dict([(s[0], s[1]) for s in symbols])
+    refs = {}
+    for section, offset, type, symbol, add in relocations:
+        refs.setdefault(section, []).append(symbol_section[symbol])
+    keep = {"*ABS*": 1, "*UND*": 1}
+    todo = [s[0] for s in sections if roots.has_key(s[0])]
+    todo += [s[1] for s in symbols if roots.has_key(s[0])]
+    while todo:
+        name = todo.pop()
+        if not keep.has_key(name):
+            keep[name] = 1
+            todo.extend(refs.get(name, []))
+    dropped = [s[0] for s in sections if not keep.has_key(s[0])]
+    sections = [s for s in sections if keep.has_key(s[0])]
+    symbols = [s for s in symbols if keep.has_key(s[1])]
+    relocations = [r for r in relocations if keep.has_key(r[0])]
+    return (sections, symbols, relocations), dropped
+
+
+# returns info without the symbols that are neither a root nor the target
+# of a relocation
+def gc_symbols(info, roots):
+    sections, symbols, relocations = info
+    keep = dict([(r[3], 1) for r in relocations])
+    symbols = [s for s in symbols if keep.has_key(s[0]) or roots.has_key(s[0])]
+    return sections, symbols, relocations
+
+
+# move the contents of the remaining sections together, starting at
+# pos; the bytes in front of it (the ELF header) stay
+def compact_sections(data, info, pos):
+    sections, symbols, relocations = info
+    out, new_sections = [data[:pos]], []
+    for name, offset, size, p2align in sections:
+        out.append(data[offset:offset+size])
+        new_sections.append((name, pos, size, p2align))
+        pos += size
+    return "".join(out), (new_sections, symbols, relocations)
+
+
+# /***********************************************************************
+# // library API
+# ************************************************************************/
+
+# returns (data, link info to append); the data (the stripped object)
+# only changes if roots are given and sections get dropped
+def objinfo(data, dump, format="bin", roots=None):
+    assert format in OBJINFO_FORMATS, format
+    xstrip.check_dump(dump)
+    if format == "text":
+        assert roots is None, "unreachable section removal needs the bin or text-min format"
+        return data, dump
+    info = parse_dump(dump)
+    if roots is not None:
+        pos = min([s[1] for s in info[0] if s[2] > 0] + [len(data)])
+        info, dropped = gc_sections(info, roots)
+        if dropped:
+            data, info = compact_sections(data, info, pos)
+        info = gc_symbols(info, roots)
+    if format == "text-min":
+        odata = format_dump(info)
+        # ElfLinker must read the same sections, symbols and
+        # relocations as from the full dump
+        assert parse_dump(odata) == info
+        return data, odata
+    odata = pack_objinfo(info, len(data))
+    # both formats must give ElfLinker the same sections, symbols
+    # and relocations
+    assert unpack_objinfo(data + odata) == (info, len(data))
+    return data, odata
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def read_file(fn):
+    fp = open(fn, "rb")
+    data = fp.read()
+    fp.close()
+    return data
+
+
+def main(argv):
+    try: assert 0
+    except AssertionError: pass
+    else: raise Exception("fatal error - assertions not enabled")
+    shortopts, longopts = "qv", ["dry-run", "format=", "gc-roots=", "gc-sources=", "quiet", "verbose"]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--dry-run"]: opts.dry_run = opts.dry_run + 1
+        elif opt in ["--format"]: opts.format = optarg
+        elif opt in ["--gc-roots"]: opts.gc_roots.append(optarg)
+        elif opt in ["--gc-sources"]: opts.gc_sources.append(optarg)
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    if opts.format not in OBJINFO_FORMATS:
+        raise Exception, "error: invalid --format %r" % opts.format
+    assert len(args) == 2, "usage: objinfo.py [--format=bin|text|text-min] [GC-OPTIONS] DUMP FILE"
+    roots = gc_roots(opts.gc_roots, opts.gc_sources)
+    dump = read_file(args[0])
+    idata = read_file(args[1])
+    data, odata = objinfo(idata, dump, opts.format, roots)
+    if (roots is not None or opts.format == "text-min") and opts.verbose >= 0:
+        old = parse_dump(dump)
+        if opts.format == "text-min":
+            new = parse_dump(odata)
+        else:
+            new = unpack_objinfo(data + odata)[0]
+        print "%s: %d of %d sections, %d of %d symbols, object -%d bytes, link info %d -> %d bytes" % (args[1], len(new[0]), len(old[0]), len(new[1]), len(old[1]), len(idata) - len(data), len(dump), len(odata))
+    if opts.verbose >= 1:
+        print >> sys.stderr, "%s: %d bytes of %s link info (dump %d bytes)" % (args[1], len(odata), opts.format, len(dump))
+    if opts.dry_run:
+        return 0
+    if data == idata:
+        fp = open(args[1], "ab")
+    else:
+        fp = open(args[1], "wb")
+        fp.write(data)
+    fp.write(odata)
+    fp.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  outfile.py -- write output files only when their contents change
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+import os, stat, tempfile
+
+
+# /***********************************************************************
+# // write a whole file
+# ************************************************************************/
+
+# Write data to fn unless fn already has exactly these contents, so that
+# the mtime of an unchanged output does not trigger needless rebuilds.
+# Regular files are replaced atomically by renaming a temporary file.
+# Returns 1 if the file was written, 0 if it was left alone.
+# As make has no restat, a make rule whose target is written this way
+# must give make something fresh, i.e. a stamp file (see the stub
+# rules in src/stub/Makefile) or a "touch $@".
+def write_if_changed(fn, data):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        st = None
+    if st is not None and not stat.S_ISREG(st.st_mode):
+        # /dev/null, a pipe or similar
+        fp = open(fn, "wb")
+        fp.write(data)
+        fp.close()
+        return 1
+    if st is not None and st.st_size == len(data):
+        fp = open(fn, "rb")
+        old = fp.read()
+        fp.close()
+        if old == data:
+            return 0
+    dirname = os.path.dirname(fn) or "."
+    fd, tmpfn = tempfile.mkstemp(dir=dirname, prefix="." + os.path.basename(fn) + ".")
+    try:
+        os.write(fd, data)
+        os.close(fd)
+        fd = None
+        if st is not None:
+            mode = stat.S_IMODE(st.st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(tmpfn, mode)
+        os.rename(tmpfn, fn)
+    except:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(tmpfn)
+        raise
+    return 1
+
+
+# A file-like object that collects all writes and calls write_if_changed()
+# on close().
+class OutputFile:
+    def __init__(self, fn):
+        self.fn = fn
+        self.chunks = []
+        self.changed = None
+
+    def write(self, s):
+        self.chunks.append(s)
+
+    def writelines(self, lines):
+        self.chunks.extend(lines)
+
+    def close(self):
+        if self.chunks is not None:
+            self.changed = write_if_changed(self.fn, "".join(self.chunks))
+            self.chunks = None
+
+
+# /***********************************************************************
+# // patch a file in place
+# ************************************************************************/
+
+# Write s at offset pos of the open file fp, unless these bytes are
+# already there. Returns 1 if the file was written, 0 otherwise.
+def patch_if_changed(fp, pos, s):
+    fp.seek(pos, 0)
+    if fp.read(len(s)) == s:
+        return 0
+    fp.seek(pos, 0)
+    fp.write(s)
+    return 1
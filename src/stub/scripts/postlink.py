@@ -0,0 +1,296 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  postlink.py -- remove sections, brand and strip ELF files in one pass
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage:
+#   postlink.py [-R SECTION]... [--bfdname=BFD --elfosabi=OS] [--strip]
+#               FILE...
+#
+# Each FILE is read once, edited in memory by the steps in EDITS and
+# written back once (only if it changed):
+#   -R, --remove-section   like "objcopy -R": the section, its relocation
+#                          sections and its section symbols go away
+#   --elfosabi             like brandelf.py
+#   --strip                like xstrip.py
+#
+# Section removal leaves the other sections where they are and only
+# rewrites the section header table, the symbol tables and the
+# relocations; the bytes of the removed sections stay behind unused
+# (sstrip drops them from the linked stubs). Allocated sections can
+# only be removed from relocatable objects.
+#
+
+
+import getopt, struct, sys
+
+import brandelf, outfile, xstrip
+
+
+class opts:
+    bfdname = None
+    dry_run = 0
+    elfosabi = None
+    remove_sections = []
+    strip = 0
+    verbose = 0
+
+
+# /***********************************************************************
+# // ELF tables
+# ************************************************************************/
+
+ET_REL = 1
+EM_MIPS = 8
+SHF_ALLOC, SHF_INFO_LINK = 0x2, 0x40
+SHT_GROUP, SHT_SYMTAB_SHNDX, SHT_DYNSYM = 17, 18, 11
+STT_SECTION = 3
+SHN_LORESERVE = 0xff00
+
+# EI_CLASS: (Elf_Sym, field order of Elf_Sym as (name, value, size,
+# info, other, shndx), Elf_Rel r_info symbol shift)
+ELF_SYMBOLS = {
+    "\x01": ("IIIBBH", (0, 1, 2, 3, 4, 5), 8),
+    "\x02": ("IBBHQQ", (0, 4, 5, 1, 2, 3), 32),
+}
+
+
+class ElfFile:
+    def __init__(self, data, fn="<data>"):
+        self.fn = fn
+        self.data = bytearray(data)
+        self.name, self.ehsize, self.ehdr, self.shdr = xstrip.elf_class(data, fn)
+        self.endian = self.ehdr.format[0]
+        self.eh = list(self.ehdr.unpack_from(data, 16))
+        sym, order, self.r_sym_shift = ELF_SYMBOLS[data[4]]
+        self.sym = struct.Struct(self.endian + sym)
+        self.sym_order = order
+        self.sections = xstrip.read_sections(data, fn)
+
+    def e_type(self): return self.eh[0]
+    def e_machine(self): return self.eh[1]
+
+    def read_shdr(self, i):
+        return list(self.shdr.unpack_from(self.data, self.eh[5] + i * self.eh[10]))
+
+    # symbols as [name, value, size, info, other, shndx]
+    def read_symbols(self, sh):
+        n = sh[5] / self.sym.size
+        syms = []
+        for i in range(n):
+            e = self.sym.unpack_from(self.data, sh[4] + i * self.sym.size)
+            syms.append([e[j] for j in self.sym_order])
+        return syms
+
+    def write_symbols(self, sh, syms):
+        for i, s in enumerate(syms):
+            e = [None] * 6
+            for j, k in enumerate(self.sym_order):
+                e[k] = s[j]
+            self.sym.pack_into(self.data, sh[4] + i * self.sym.size, *e)
+
+
+# /***********************************************************************
+# // edits
+# ************************************************************************/
+
+def remove_sections(elf, names):
+    if not names:
+        return 0
+    if elf.sections is None:
+        raise Exception, "%s: no section header table" % elf.fn
+    raw = [elf.read_shdr(i) for i in range(len(elf.sections))]
+    removed = {}
+    for i, sh in enumerate(elf.sections):
+        if i > 0 and sh[0] in names:
+            removed[i] = 1
+    # and the relocations for them
+    for i, sh in enumerate(elf.sections):
+        if sh[1] in [xstrip.SHT_REL, xstrip.SHT_RELA] and removed.has_key(sh[7]):
+            removed[i] = 1
+    if not removed:
+        return 0
+    for i in removed.keys():
+        sh = elf.sections[i]
+        if sh[1] in [xstrip.SHT_SYMTAB, SHT_DYNSYM] or i == elf.eh[12]:
+            raise Exception, "%s: cannot remove %s" % (elf.fn, sh[0])
+        if sh[2] & SHF_ALLOC and elf.e_type() != ET_REL:
+            raise Exception, "%s: cannot remove allocated section %s" % (elf.fn, sh[0])
+    for sh in elf.sections:
+        if sh[1] == SHT_SYMTAB_SHNDX:
+            raise Exception, "%s: section %s is not supported" % (elf.fn, sh[0])
+    index, n = {0: 0}, 0
+    for i in range(1, len(elf.sections)):
+        if not removed.has_key(i):
+            n += 1
+            index[i] = n
+    def shndx(i, what):
+        if i == 0 or i >= SHN_LORESERVE:
+            return i
+        if not index.has_key(i):
+            raise Exception, "%s: %s refers to a removed section" % (elf.fn, what)
+        return index[i]
+    # section groups: flags, then the member sections
+    word = struct.Struct(elf.endian + "I")
+    for i, sh in enumerate(elf.sections):
+        if sh[1] != SHT_GROUP or removed.has_key(i):
+            continue
+        words = [word.unpack_from(elf.data, pos)[0] for pos in range(sh[4], sh[4] + sh[5], 4)]
+        words = words[:1] + [index[w] for w in words[1:] if not removed.has_key(w)]
+        for j, w in enumerate(words):
+            word.pack_into(elf.data, sh[4] + 4 * j, w)
+        raw[i][5] = 4 * len(words)
+    # symbol tables: drop the section symbols of removed sections
+    for i, sh in enumerate(elf.sections):
+        if sh[1] not in [xstrip.SHT_SYMTAB, SHT_DYNSYM]:
+            continue
+        syms = elf.read_symbols(sh)
+        new_syms, sym_index, nlocal = [], {}, 0
+        for j, s in enumerate(syms):
+            if j > 0 and s[5] < SHN_LORESERVE and removed.has_key(s[5]):
+                if s[3] & 0xf != STT_SECTION:
+                    raise Exception, "%s: symbol in removed section %s" % (elf.fn, elf.sections[s[5]][0])
+                continue
+            s[5] = shndx(s[5], "a symbol")
+            sym_index[j] = len(new_syms)
+            new_syms.append(s)
+            if j < sh[7]:
+                nlocal += 1
+        elf.write_symbols(sh, new_syms)
+        raw[i][5] = len(new_syms) * elf.sym.size
+        raw[i][7] = nlocal
+        # relocations against this symbol table
+        for k, rsh in enumerate(elf.sections):
+            if rsh[1] not in [xstrip.SHT_REL, xstrip.SHT_RELA] or rsh[6] != i or removed.has_key(k):
+                continue
+            if len(new_syms) == len(syms):
+                continue
+            if elf.r_sym_shift == 32 and elf.e_machine() == EM_MIPS:
+                raise Exception, "%s: MIPS64 relocations are not supported" % elf.fn
+            fmt = elf.endian + {4: "II", 8: "QQ"}[rsh[9] / (2 + (rsh[1] == xstrip.SHT_RELA))]
+            for pos in range(rsh[4], rsh[4] + rsh[5], rsh[9]):
+                r_offset, r_info = struct.unpack_from(fmt, elf.data, pos)
+                sym = r_info >> elf.r_sym_shift
+                if not sym_index.has_key(sym):
+                    raise Exception, "%s: relocation in %s against a removed section" % (elf.fn, rsh[0])
+                r_info = (sym_index[sym] << elf.r_sym_shift) | (r_info & ((1L << elf.r_sym_shift) - 1))
+                struct.pack_into(fmt, elf.data, pos, r_offset, r_info)
+    # the section header table, in place
+    out = []
+    for i, sh in enumerate(raw):
+        if removed.has_key(i):
+            continue
+        name = elf.sections[i][0]
+        sh[6] = shndx(sh[6], "the sh_link of " + name)
+        if sh[1] in [xstrip.SHT_REL, xstrip.SHT_RELA] or sh[2] & SHF_INFO_LINK:
+            sh[7] = shndx(sh[7], "the sh_info of " + name)
+        out.append(sh)
+    for i, sh in enumerate(out):
+        elf.shdr.pack_into(elf.data, elf.eh[5] + i * elf.eh[10], *sh)
+    elf.eh[11] = len(out)
+    elf.eh[12] = index[elf.eh[12]]
+    elf.ehdr.pack_into(elf.data, 16, *elf.eh)
+    return len(removed)
+
+
+def brand(elf, bfdname, elfosabi):
+    if elfosabi is None:
+        return 0
+    s = brandelf.elf_brand(str(elf.data[:16]), bfdname, elfosabi, elf.fn)
+    elf.data[7:7+len(s)] = s
+    return 1
+
+
+def strip(elf, enabled):
+    if not enabled:
+        return 0
+    r = xstrip.strip_extent(str(elf.data), None, elf.fn)
+    if r is None:
+        return 0
+    ehsize, new_len = r
+    # clear e_shnum, e_shstrndx
+    elf.data[ehsize-4:ehsize] = struct.pack("I", 0)
+    del elf.data[new_len:]
+    return 1
+
+
+# in this order; each edit returns non-zero if it did anything
+EDITS = [
+    ("remove", lambda elf: remove_sections(elf, opts.remove_sections)),
+    ("brand",  lambda elf: brand(elf, opts.bfdname, opts.elfosabi)),
+    ("strip",  lambda elf: strip(elf, opts.strip)),
+]
+
+
+# library API: return the edited data, and the names of the edits done
+def edit_data(idata, fn="<data>"):
+    elf = ElfFile(idata, fn)
+    done = [name for name, f in EDITS if f(elf)]
+    return str(elf.data), done
+
+
+def do_file(fn):
+    fp = open(fn, "rb")
+    idata = fp.read()
+    fp.close()
+    odata, done = edit_data(idata, fn)
+    if opts.verbose >= 1:
+        print >> sys.stderr, "%s: %s, %d -> %d bytes" % (fn, " ".join(done) or "unchanged", len(idata), len(odata))
+    if not opts.dry_run and odata != idata:
+        outfile.write_if_changed(fn, odata)
+
+
+def main(argv):
+    try: assert 0
+    except AssertionError: pass
+    else: raise Exception("fatal error - assertions not enabled")
+    shortopts, longopts = "qvR:", [
+        "bfdname=", "dry-run", "elfosabi=", "quiet", "remove-section=", "strip", "verbose"
+    ]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--dry-run"]: opts.dry_run = opts.dry_run + 1
+        elif opt in ["--bfdname"]: opts.bfdname = optarg.lower()
+        elif opt in ["--elfosabi"]: opts.elfosabi = optarg.lower()
+        elif opt in ["-R", "--remove-section"]: opts.remove_sections.append(optarg)
+        elif opt in ["--strip"]: opts.strip = opts.strip + 1
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    # process arguments
+    if not args:
+        raise Exception, "error: no arguments given"
+    for arg in args:
+        do_file(arg)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
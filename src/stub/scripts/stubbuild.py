@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  stubbuild.py -- build the stubs in parallel along the Makefile DAG
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage (from src/stub):
+#   python scripts/stubbuild.py [-j N] [--dry-run] [VAR=value...] [TARGET...]
+#
+# src/stub/Makefile is .NOTPARALLEL, so "make all" builds one recipe
+# after the other. This script reads the file-level dependency graph
+# from "make -pq" and runs "make TARGET" for each node on a pool of
+# workers, starting dependencies first. All commands still come from
+# the Makefile, so the outputs are the same as with plain make. Among
+# the ready nodes the one with the longest remaining critical path goes
+# first. Path lengths use the node times from the previous run, which
+# are kept in tmp/.stubbuild-times.
+#
+
+
+import getopt, json, multiprocessing, os, re, subprocess, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import outfile
+
+
+class opts:
+    dry_run = 0
+    jobs = 0
+    make = os.environ.get("MAKE", "make")
+    times_file = "tmp/.stubbuild-times"
+    verbose = 0
+
+
+# /***********************************************************************
+# // read the make database
+# ************************************************************************/
+
+# returns ({target: [prerequisites]}, {targets with a recipe}, {phony})
+def read_make_db(make_args):
+    p = subprocess.Popen([opts.make, "-pq"] + make_args, stdout=subprocess.PIPE)
+    db = p.communicate()[0]
+    # "make -q" exits with 1 if anything is out of date
+    if p.returncode not in [0, 1]:
+        raise Exception, "error: %s -pq failed" % opts.make
+    deps, recipes, phony = {}, {}, {}
+    p = db.find("\n# Files\n")
+    assert p >= 0, "no file database in make -p output"
+    for entry in re.split(r"\n\n+", db[p:]):
+        lines = entry.split("\n")
+        if lines[0].startswith("# files hash-table stats"):
+            break
+        if "# Not a target:" in lines:
+            continue
+        has_recipe, target = 0, None
+        for l in lines:
+            if l.startswith("\t") or l.startswith("#  recipe to execute"):
+                has_recipe = 1
+                continue
+            if l.startswith("#") or not l:
+                continue
+            m = re.search(r"^(.+?)::?\s*(.*)$", l)
+            if not m:
+                continue
+            # target-specific variable assignment
+            if re.search(r"^\S+\s*[:+?!]?=", m.group(2)):
+                continue
+            target, rest = m.groups()
+            rest = rest.replace("|", " ")
+            deps.setdefault(target, [])
+            for d in rest.split():
+                if d not in deps[target]:
+                    deps[target].append(d)
+            if target == ".PHONY":
+                for d in rest.split():
+                    phony[d] = 1
+        if has_recipe and target is not None:
+            recipes[target] = 1
+    return deps, recipes, phony
+
+
+# the nodes reachable from goals, each with its prerequisites that are
+# nodes themselves; existing files without a recipe are plain inputs,
+# missing ones are left to make (e.g. the %/.tmp-stamp pattern rule)
+def build_graph(goals, deps, recipes, phony):
+    graph = {}
+    todo = list(goals)
+    while todo:
+        t = todo.pop()
+        if graph.has_key(t):
+            continue
+        graph[t] = []
+        for d in deps.get(t, []):
+            if recipes.has_key(d) or phony.has_key(d) or not os.path.exists(d):
+                graph[t].append(d)
+                todo.append(d)
+    return graph
+
+
+# longest (estimated) time from each node to the end of the build
+def critical_paths(graph, cost):
+    users = dict([(t, []) for t in graph.keys()])
+    for t, ds in graph.items():
+        for d in ds:
+            users[d].append(t)
+    cp = {}
+    def visit(t):
+        if not cp.has_key(t):
+            cp[t] = None
+            cp[t] = cost(t) + max([0.0] + [visit(u) for u in users[t]])
+        assert cp[t] is not None, ("dependency cycle", t)
+        return cp[t]
+    for t in graph.keys():
+        visit(t)
+    return cp
+
+
+# /***********************************************************************
+# // run
+# ************************************************************************/
+
+def read_times():
+    try:
+        return json.load(open(opts.times_file, "rb"))
+    except (IOError, ValueError):
+        return {}
+
+
+def run_graph(graph, make_args, recipes, phony):
+    old_times = read_times()
+    def skip(t):
+        # e.g. "all", or an input with a phony prerequisite
+        return not recipes.has_key(t) and (phony.has_key(t) or os.path.exists(t))
+    def cost(t):
+        if skip(t):
+            return 0.0
+        return old_times.get(t, 1.0)
+    cp = critical_paths(graph, cost)
+    waiting = dict([(t, len(ds)) for t, ds in graph.items()])
+    users = dict([(t, []) for t in graph.keys()])
+    for t, ds in graph.items():
+        for d in ds:
+            users[d].append(t)
+    ready = [t for t, n in waiting.items() if n == 0]
+    running, times, failed = {}, {}, []
+    njobs = opts.jobs
+    if njobs <= 0:
+        njobs = multiprocessing.cpu_count()
+    t_start = time.time()
+    def done(t):
+        for u in users[t]:
+            waiting[u] -= 1
+            if waiting[u] == 0:
+                ready.append(u)
+    while ready or running:
+        # start the ready node with the longest critical path
+        while ready and len(running) < njobs and not failed:
+            ready.sort(key=lambda t: (cp[t], t))
+            t = ready.pop()
+            if skip(t):
+                times[t] = (0.0, 0.0)
+                done(t)
+                continue
+            if opts.dry_run:
+                print "%s %s" % (opts.make, t)
+                times[t] = (time.time() - t_start, 0.0)
+                done(t)
+                continue
+            if opts.verbose >= 1:
+                print >> sys.stderr, "stubbuild: start %s (critical path %.2fs)" % (t, cp[t])
+            p = subprocess.Popen([opts.make, "--no-print-directory"] + make_args + [t])
+            running[p.pid] = (t, time.time(), p)
+        if not running:
+            if failed:
+                break
+            continue
+        pid, status = os.wait()
+        if not running.has_key(pid):
+            continue
+        t, t0, p = running.pop(pid)
+        p.returncode = status
+        times[t] = (t0 - t_start, time.time() - t0)
+        if status != 0:
+            failed.append(t)
+            print >> sys.stderr, "stubbuild: *** %s failed" % t
+        else:
+            done(t)
+    wall = time.time() - t_start
+    if not opts.dry_run and not failed:
+        new_times = dict(old_times)
+        for t, (start, d) in times.items():
+            if not skip(t):
+                new_times[t] = round(d, 3)
+        if os.path.isdir(os.path.dirname(opts.times_file) or "."):
+            outfile.write_if_changed(opts.times_file, json.dumps(new_times, indent=1, separators=(",", ": "), sort_keys=True) + "\n")
+    return times, wall, cp, failed
+
+
+def print_timings(times, wall, cp, njobs):
+    rows = [(d, start, t) for t, (start, d) in times.items() if d > 0.0]
+    rows.sort(reverse=True)
+    print "%8s %8s  %s" % ("start", "time", "target")
+    for d, start, t in rows:
+        print "%8.2f %8.2f  %s" % (start, d, t)
+    busy = sum([r[0] for r in rows])
+    print "%d nodes, wall %.2fs, busy %.2fs, parallelism %.2f of %d, estimated critical path %.2fs" % (len(rows), wall, busy, busy / max(wall, 1e-9), njobs, max([0.0] + cp.values()))
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def main(argv):
+    shortopts, longopts = "j:nqv", ["dry-run", "jobs=", "make=", "quiet", "verbose"]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["-n", "--dry-run"]: opts.dry_run = opts.dry_run + 1
+        elif opt in ["-j", "--jobs"]: opts.jobs = int(optarg)
+        elif opt in ["--make"]: opts.make = optarg
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    # VAR=value arguments go to every make run
+    make_args = [a for a in args if "=" in a]
+    goals = [a for a in args if "=" not in a] or ["all"]
+    deps, recipes, phony = read_make_db(make_args)
+    graph = build_graph(goals, deps, recipes, phony)
+    times, wall, cp, failed = run_graph(graph, make_args, recipes, phony)
+    if opts.verbose >= 0 and not opts.dry_run:
+        njobs = opts.jobs
+        if njobs <= 0:
+            njobs = multiprocessing.cpu_count()
+        print_timings(times, wall, cp, njobs)
+    if failed:
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  stubchain.py -- xstrip, append the objdump dump and bin2h in one go
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage:
+#   stubchain.py --with-dump=tmp/T.bin.dump [--compact]
+#                [--format=bin|text|text-min]
+#                [--gc-roots=FILE] [--gc-sources=GLOB]
+#                [BIN2H-OPTIONS] tmp/T.bin T.h
+#
+# does the same as the tail of tc.default.f-embed_objinfo plus bin2h:
+#   xstrip [--compact] tmp/T.bin
+#   objinfo [--format=bin|text|text-min] [--gc-...] tmp/T.bin.dump tmp/T.bin
+#   bin2h [BIN2H-OPTIONS] tmp/T.bin T.h
+# but keeps the data in memory between the steps.
+#
+
+
+import os, sys
+
+import bin2h, objinfo, outfile, xstrip
+
+
+# /***********************************************************************
+# // library API
+# ************************************************************************/
+
+# the stripped object with its link info appended, as read by ElfLinker
+def embed_objinfo(obj, dump, fn="<data>", format="bin", roots=None):
+    odata = xstrip.strip_elf(obj, dump, fn)
+    if odata is None:
+        odata = obj
+    odata, info = objinfo.objinfo(odata, dump, format, roots)
+    return odata + info
+
+
+# embed_objinfo() followed by bin2h; returns (stub data, header text)
+def objinfo_to_header(obj, dump, ifile, ofile, format="bin", roots=None, **bin2h_opts):
+    data = embed_objinfo(obj, dump, ifile, format, roots)
+    return data, bin2h.bin2h_data(data, ifile, ofile, **bin2h_opts)
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def read_file(fn):
+    fp = open(fn, "rb")
+    data = fp.read()
+    fp.close()
+    return data
+
+
+def main(argv):
+    try: assert 0
+    except AssertionError: pass
+    else: raise Exception("fatal error - assertions not enabled")
+    # --with-dump, --compact, --format and --gc-* are ours, everything
+    # else goes to bin2h
+    dump_fn, compact, format, roots_fns, source_patterns, rest = None, 0, "bin", [], [], []
+    for arg in argv[1:]:
+        if arg.startswith("--with-dump="):
+            dump_fn = arg[len("--with-dump="):]
+        elif arg == "--compact":
+            compact = 1
+        elif arg.startswith("--format="):
+            format = arg[len("--format="):]
+        elif arg.startswith("--gc-roots="):
+            roots_fns.append(arg[len("--gc-roots="):])
+        elif arg.startswith("--gc-sources="):
+            source_patterns.append(arg[len("--gc-sources="):])
+        else:
+            rest.append(arg)
+    if not dump_fn:
+        raise Exception, "error: --with-dump is required"
+    args = bin2h.parse_opts(rest)
+    assert len(args) == 2, "usage: stubchain.py --with-dump=DUMP [--compact] [--format=bin|text|text-min] [--gc-...] [BIN2H-OPTIONS] ifile ofile"
+    ifile, ofile = os.path.normpath(args[0]), args[1]
+    cache = None
+    if bin2h.opts.cache_dir:
+        cache = bin2h.StubCache(bin2h.opts.cache_dir, bin2h.opts.cache_size)
+    roots = objinfo.gc_roots(roots_fns, source_patterns)
+    obj, dump = read_file(ifile), read_file(dump_fn)
+    if compact:
+        r = xstrip.compact_elf(obj, dump, ifile)
+        if r is not None:
+            obj, dump = r
+            # like xstrip --compact, which rewrites the dump
+            outfile.write_if_changed(dump_fn, dump)
+    data, header = objinfo_to_header(obj, dump, ifile, ofile, format, roots, cache=cache)
+    # keep tmp/T.bin as the Makefile would leave it
+    outfile.write_if_changed(ifile, data)
+    outfile.write_if_changed(ofile, header)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  stubmetrics.py -- read, write and compare bin2h.py --metrics files
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage:
+#   stubmetrics.py FILE                 list the stubs in a metrics file
+#   stubmetrics.py OLD NEW              compare two metrics files
+#
+# The exit code of a compare is 1 if any stub grew beyond the
+# thresholds, so it can be used as a release check.
+#
+
+
+import csv, getopt, json, os, sys
+
+import outfile
+
+
+class opts:
+    min_time = 0.05
+    size_threshold = 0.0
+    time_threshold = 50.0
+    verbose = 0
+
+
+# /***********************************************************************
+# // metrics files
+# ************************************************************************/
+
+# A metrics file holds one record per stub, keyed by the stub ident
+# (or by the input file for stubs without an ident):
+#   ident, ifile      stub name and input file
+#   size              uncompressed size
+#   adler32, crc32    checksums of the uncompressed data
+#   methods           {method: compressed size}
+#   best_method       the method written (the --compress=auto choice,
+#                     else the one with the smallest output)
+#   smallest_method   the method with the smallest output
+#   time              seconds spent compressing (0.0 if cached)
+#   cached            number of methods taken from the bin2h cache
+# The format (JSON or CSV) is chosen by the file extension.
+
+CSV_FIELDS = ["ident", "ifile", "size", "adler32", "crc32", "best_method", "smallest_method", "time", "cached"]
+
+
+def is_csv(fn):
+    return fn.lower().endswith(".csv")
+
+
+def record_key(r):
+    return r["ident"] or r["ifile"]
+
+
+def read_metrics(fn):
+    if not os.path.isfile(fn):
+        return {}
+    records = []
+    fp = open(fn, "rb")
+    if is_csv(fn):
+        for row in csv.DictReader(fp):
+            r = {}
+            for k in ["ident", "ifile", "adler32", "crc32"]:
+                r[k] = row[k]
+            for k in ["size", "best_method", "cached"]:
+                r[k] = int(row[k])
+            # older files have no smallest_method column
+            r["smallest_method"] = int(row.get("smallest_method") or r["best_method"])
+            r["time"] = float(row["time"])
+            r["methods"] = {}
+            for k, v in row.items():
+                if k.startswith("m") and k[1:].isdigit() and v != "":
+                    r["methods"][int(k[1:])] = int(v)
+            records.append(r)
+    else:
+        for r in json.load(fp):
+            r = dict([(str(k), v) for k, v in r.items()])
+            r["methods"] = dict([(int(k), v) for k, v in r["methods"].items()])
+            r.setdefault("smallest_method", r["best_method"])
+            records.append(r)
+    fp.close()
+    return dict([(record_key(r), r) for r in records])
+
+
+def write_metrics(fn, records):
+    keys = sorted(records.keys())
+    if is_csv(fn):
+        methods = {}
+        for r in records.values():
+            for m in r["methods"].keys():
+                methods[m] = 1
+        fields = CSV_FIELDS + ["m%d" % m for m in sorted(methods.keys())]
+        ofp = outfile.OutputFile(fn)
+        cw = csv.writer(ofp, lineterminator="\n")
+        cw.writerow(fields)
+        for k in keys:
+            r = records[k]
+            row = [r[f] for f in CSV_FIELDS]
+            row += [r["methods"].get(m, "") for m in sorted(methods.keys())]
+            cw.writerow(row)
+        ofp.close()
+    else:
+        l = []
+        for k in keys:
+            r = dict(records[k])
+            r["methods"] = dict([(str(m), v) for m, v in r["methods"].items()])
+            l.append(r)
+        outfile.write_if_changed(fn, json.dumps(l, indent=1, separators=(",", ": "), sort_keys=True) + "\n")
+
+
+# merge new records into a metrics file, replacing those of the same stub;
+# fn.lock serializes concurrent bin2h runs sharing one metrics file
+def update_metrics(fn, new_records):
+    import fcntl
+    lfp = open(fn + ".lock", "wb")
+    try:
+        fcntl.lockf(lfp, fcntl.LOCK_EX)
+        records = read_metrics(fn)
+        for r in new_records:
+            records[record_key(r)] = r
+        write_metrics(fn, records)
+    finally:
+        lfp.close()
+
+
+# /***********************************************************************
+# // report
+# ************************************************************************/
+
+def grew(old, new, threshold):
+    return new > old + old * threshold / 100.0
+
+
+def compare_metrics(old, new):
+    flagged = []
+    def report(k, what):
+        print "%-40s %s" % (k, what)
+    for k in sorted(new.keys()):
+        n = new[k]
+        if not old.has_key(k):
+            if opts.verbose >= 0:
+                report(k, "new stub, %d bytes" % n["size"])
+            continue
+        o = old[k]
+        problems = []
+        if grew(o["size"], n["size"], opts.size_threshold):
+            problems.append("size %d -> %d" % (o["size"], n["size"]))
+        for m in sorted(n["methods"].keys()):
+            if o["methods"].has_key(m) and grew(o["methods"][m], n["methods"][m], opts.size_threshold):
+                problems.append("method %d: %d -> %d" % (m, o["methods"][m], n["methods"][m]))
+        # cached results carry no timing
+        if not o["cached"] and not n["cached"]:
+            if grew(o["time"], n["time"], opts.time_threshold) and n["time"] - o["time"] >= opts.min_time:
+                problems.append("time %.3fs -> %.3fs" % (o["time"], n["time"]))
+        if problems:
+            flagged.append(k)
+            report(k, "GREW: " + ", ".join(problems))
+        elif opts.verbose >= 1:
+            report(k, "ok")
+    for k in sorted(old.keys()):
+        if not new.has_key(k) and opts.verbose >= 0:
+            report(k, "removed")
+    if opts.verbose >= 0:
+        o_size = sum([old[k]["size"] for k in old.keys() if new.has_key(k)])
+        n_size = sum([new[k]["size"] for k in new.keys() if old.has_key(k)])
+        print "%d stubs compared, %d flagged, common uncompressed size %d -> %d bytes" % (len([k for k in new.keys() if old.has_key(k)]), len(flagged), o_size, n_size)
+    return flagged
+
+
+def list_metrics(records):
+    for k in sorted(records.keys()):
+        r = records[k]
+        methods = " ".join(["m%d=%d" % (m, r["methods"][m]) for m in sorted(r["methods"].keys())])
+        print "%-40s %6d  best=%-2d %7.3fs  %s" % (k, r["size"], r["best_method"], r["time"], methods)
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def main(argv):
+    shortopts, longopts = "qv", ["min-time=", "quiet", "size-threshold=", "time-threshold=", "verbose"]
+    xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
+    for opt, optarg in xopts:
+        if 0: pass
+        elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
+        elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--min-time"]: opts.min_time = float(optarg)
+        elif opt in ["--size-threshold"]: opts.size_threshold = float(optarg)
+        elif opt in ["--time-threshold"]: opts.time_threshold = float(optarg)
+        else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
+    if len(args) == 1:
+        list_metrics(read_metrics(args[0]))
+        return 0
+    assert len(args) == 2, "usage: stubmetrics.py [OPTIONS] OLD NEW"
+    for fn in args:
+        if not os.path.isfile(fn):
+            raise Exception, "error: %s: no such file" % fn
+    if compare_metrics(read_metrics(args[0]), read_metrics(args[1])):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,327 @@
+#! /usr/bin/env python
+## vim:set ts=4 sw=4 et: -*- coding: utf-8 -*-
+#
+#  stubtool.py -- run the stub tools, optionally through a worker daemon
+#
+#  This file is part of the UPX executable compressor.
+#
+#  Copyright (C) 1996-2018 Markus Franz Xaver Johannes Oberhumer
+#  All Rights Reserved.
+#
+#  UPX and the UCL library are free software; you can redistribute them
+#  and/or modify them under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; see the file COPYING.
+#  If not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#  Markus F.X.J. Oberhumer              Laszlo Molnar
+#  <markus@oberhumer.com>               <ezerotven+github@gmail.com>
+#
+
+
+#
+# usage:
+#   stubtool.py TOOL [ARGS...]      run TOOL (bin2h, brandelf, gpp_inc,
+#                                   gpp_mkdep, objinfo, postlink,
+#                                   stubchain, stubmetrics or xstrip)
+#   stubtool.py --daemon            start the worker daemon
+#   stubtool.py --stop              stop the worker daemon
+#
+# The daemon imports all tools once and forks a fresh child for every
+# request, so each run still starts with pristine module state (the
+# global opts classes) but without the cost of importing the tools.
+# The client still is a Python interpreter: the Makefile runs it as
+# "python -S", and it imports only a few small modules before it
+# connects, so that it costs little more than bare interpreter
+# startup. If no daemon is running the tool runs in this process.
+#
+# The socket is $UPX_STUBTOOL_SOCKET, or a per-user default in the temp
+# directory. Its directory must be a real directory owned by the user
+# with mode 0700, else the daemon refuses to start and the tools run
+# in-process. The daemon exits as soon as one of the tool scripts
+# changes on disk, so it never runs stale code.
+#
+
+
+# keep the client imports small - they are paid on every run
+# (_socket: socket.py pulls in ssl, functools and warnings)
+import _socket, os, stat, struct, sys
+
+
+# tool: (module, extra leading arguments)
+TOOLS = {
+    "bin2h":       ("bin2h", []),
+    "brandelf":    ("brandelf", []),
+    "gpp_inc":     ("gpp_inc", []),
+    "gpp_mkdep":   ("gpp_inc", ["--deps-only"]),
+    "objinfo":     ("objinfo", []),
+    "postlink":    ("postlink", []),
+    "stubchain":   ("stubchain", []),
+    "stubmetrics": ("stubmetrics", []),
+    "xstrip":      ("xstrip", []),
+}
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def socket_path():
+    fn = os.environ.get("UPX_STUBTOOL_SOCKET")
+    if fn:
+        return fn
+    # like tempfile.gettempdir(), without importing it
+    tmpdir = "/tmp"
+    for k in ["TMPDIR", "TEMP", "TMP"]:
+        if os.environ.get(k):
+            tmpdir = os.environ[k]
+            break
+    return os.path.join(tmpdir, "upx-stubtool-%d" % os.getuid(), "socket")
+
+
+# the socket directory must not be a symlink and nobody else may be
+# able to replace the socket in it
+def socket_dir_ok(d):
+    try:
+        st = os.lstat(d)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0700
+
+
+# /***********************************************************************
+# // run a tool in this process
+# ************************************************************************/
+
+def run_tool(tool, args):
+    if not TOOLS.has_key(tool):
+        raise Exception, "error: unknown tool %r" % tool
+    modname, extra = TOOLS[tool]
+    # the tools may need site-packages (e.g. backports.lzma) even when
+    # running under "python -S"
+    import site
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+    m = __import__(modname)
+    try:
+        rc = m.main([os.path.join(SCRIPTS_DIR, modname + ".py")] + extra + args)
+    except SystemExit, e:
+        rc = e.code
+    if rc is None:
+        return 0
+    if not isinstance(rc, int):
+        print >> sys.stderr, rc
+        return 1
+    return rc
+
+
+# /***********************************************************************
+# // protocol
+# ************************************************************************/
+
+# A request is a length-prefixed string of NUL-separated fields:
+#   tool, cwd, umask, args...
+# The reply is a sequence of frames (kind, length, data):
+#   "1" stdout data, "2" stderr data, "x" exit status,
+#   "s" daemon is stale - run the tool in-process instead.
+
+def send_frame(sock, kind, data):
+    sock.sendall(kind + struct.pack("<I", len(data)) + data)
+
+
+def recv_exact(sock, n):
+    buf = []
+    while n > 0:
+        s = sock.recv(min(n, 65536))
+        if not s:
+            raise EOFError
+        buf.append(s)
+        n -= len(s)
+    return "".join(buf)
+
+
+def recv_frame(sock):
+    h = recv_exact(sock, 5)
+    n = struct.unpack("<I", h[1:])[0]
+    return h[0], recv_exact(sock, n)
+
+
+class FrameWriter:
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+        self.softspace = 0
+    def write(self, s):
+        if s:
+            send_frame(self.sock, self.kind, s)
+    def writelines(self, lines):
+        for s in lines:
+            self.write(s)
+    def flush(self):
+        pass
+
+
+# /***********************************************************************
+# // client
+# ************************************************************************/
+
+# returns the exit status, or None if there is no (usable) daemon
+def run_remote(tool, args):
+    fn = socket_path()
+    if not socket_dir_ok(os.path.dirname(fn) or "."):
+        return None
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(fn)
+    except _socket.error:
+        sock.close()
+        return None
+    umask = os.umask(0)
+    os.umask(umask)
+    req = "\0".join([tool, os.getcwd(), "%o" % umask] + args)
+    send_frame(sock, "r", req)
+    try:
+        while 1:
+            kind, data = recv_frame(sock)
+            if kind == "1":
+                sys.stdout.write(data)
+            elif kind == "2":
+                sys.stderr.write(data)
+            elif kind == "x":
+                sys.stdout.flush()
+                return int(data)
+            elif kind == "s":
+                return None
+    except EOFError:
+        return None
+    finally:
+        sock.close()
+
+
+def client(tool, args):
+    # stdin is not forwarded to the daemon
+    if "-" in args or "--manifest=-" in args:
+        return run_tool(tool, args)
+    rc = run_remote(tool, args)
+    if rc is None:
+        rc = run_tool(tool, args)
+    return rc
+
+
+# /***********************************************************************
+# // daemon
+# ************************************************************************/
+
+def tool_mtimes():
+    return [os.stat(os.path.join(SCRIPTS_DIR, f)).st_mtime
+            for f in sorted(os.listdir(SCRIPTS_DIR)) if f.endswith(".py")]
+
+
+def serve_request(conn, req):
+    fields = req.split("\0")
+    tool, cwd, umask, args = fields[0], fields[1], int(fields[2], 8), fields[3:]
+    sys.stdin = open(os.devnull, "rb")
+    sys.stdout = FrameWriter(conn, "1")
+    sys.stderr = FrameWriter(conn, "2")
+    try:
+        os.chdir(cwd)
+        os.umask(umask)
+        rc = run_tool(tool, args)
+    except:
+        import traceback
+        traceback.print_exc()
+        rc = 1
+    send_frame(conn, "x", str(rc))
+
+
+def daemon():
+    import errno, signal, site, socket
+    fn = socket_path()
+    d = os.path.dirname(fn) or "."
+    if not os.path.lexists(d):
+        os.makedirs(d, 0700)
+    if not socket_dir_ok(d):
+        raise Exception, "error: %s is not a directory of mode 0700 owned by uid %d" % (d, os.getuid())
+    # replace a running daemon
+    run_remote("--stop", [])
+    if os.path.exists(fn):
+        os.unlink(fn)
+    # preload all tools
+    sys.path.insert(0, SCRIPTS_DIR)
+    for modname, extra in TOOLS.values():
+        __import__(modname)
+    mtimes = tool_mtimes()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    sock.bind(fn)
+    os.umask(umask)
+    sock.listen(64)
+    # detach once the socket is ready
+    if os.fork() != 0:
+        os._exit(0)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in [0, 1, 2]:
+        os.dup2(devnull, fd)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    try:
+        while 1:
+            try:
+                conn, addr = sock.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                kind, req = recv_frame(conn)
+            except (EOFError, socket.error):
+                conn.close()
+                continue
+            if req.split("\0")[0] == "--stop":
+                conn.close()
+                break
+            if tool_mtimes() != mtimes:
+                send_frame(conn, "s", "")
+                conn.close()
+                break
+            if os.fork() == 0:
+                sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                try:
+                    serve_request(conn, req)
+                finally:
+                    os._exit(0)
+            conn.close()
+    finally:
+        sock.close()
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+    return 0
+
+
+# /***********************************************************************
+# // main
+# ************************************************************************/
+
+def main(argv):
+    if len(argv) < 2:
+        raise Exception, "usage: stubtool.py TOOL [ARGS...] | --daemon | --stop"
+    if argv[1] == "--daemon":
+        return daemon()
+    if argv[1] == "--stop":
+        run_remote("--stop", [])
+        return 0
+    return client(argv[1], argv[2:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
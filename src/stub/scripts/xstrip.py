@@ -28,10 +28,11 @@
 #
 
 
-import getopt, os, re, string, struct, sys
+import getopt, mmap, os, re, string, struct, sys
 
 
 class opts:
+    compact = 0
     dry_run = 0
     verbose = 0
     bindump = None
@@ -42,10 +43,10 @@ class opts:
 # //
 # ************************************************************************/
 
-def strip_with_dump(dump_fn, eh, idata):
+# the end of the last CONTENTS section in the dump
+def dump_extent(dump):
     new_len = 0
-    lines = open(dump_fn, "rb").readlines()
-    for l in lines:
+    for l in dump.splitlines():
         l = re.sub(r"\s+", " ", l.strip())
         f = l.split(" ")
         if len(f) >= 8:
@@ -55,18 +56,15 @@ def strip_with_dump(dump_fn, eh, idata):
                 if sh_offset + sh_size > new_len:
                     new_len = sh_offset + sh_size
                     ##print sh_offset, sh_size, f
-    if new_len > len(eh):
-        ##print dump_fn, new_len
-        return eh, idata[:new_len-len(eh)]
-    return eh, idata
+    return new_len
 
 
 # /***********************************************************************
 # // FIXME - this is only a first stub version
 # ************************************************************************/
 
-def check_dump(dump_fn):
-    lines = open(dump_fn, "rb").readlines()
+def check_dump(dump):
+    lines = dump.splitlines()
     lines = map(lambda l: re.sub(r"\s+", " ", l.strip()).strip(), lines)
     lines = filter(None, lines)
     d = "\n".join(lines)
@@ -127,68 +125,251 @@ def check_dump(dump_fn):
 
 
 # /***********************************************************************
-# //
+# // ELF section header table
 # ************************************************************************/
 
+# EI_CLASS + EI_DATA + EI_VERSION: (name, e_ehsize, Elf_Ehdr after
+# e_ident, Elf_Shdr)
+ELF_CLASSES = {
+    "\x01\x01\x01": ("ELF32 LE", 52, struct.Struct("<HHIIIIIHHHHHH"), struct.Struct("<IIIIIIIIII")),
+    "\x01\x02\x01": ("ELF32 BE", 52, struct.Struct(">HHIIIIIHHHHHH"), struct.Struct(">IIIIIIIIII")),
+    "\x02\x01\x01": ("ELF64 LE", 64, struct.Struct("<HHIQQQIHHHHHH"), struct.Struct("<IIQQQQIIQQ")),
+    "\x02\x02\x01": ("ELF64 BE", 64, struct.Struct(">HHIQQQIHHHHHH"), struct.Struct(">IIQQQQIIQQ")),
+}
+
+SHT_NULL, SHT_SYMTAB, SHT_STRTAB, SHT_RELA, SHT_NOBITS, SHT_REL = 0, 2, 3, 4, 8, 9
+
+# section types that "objdump -h" does not list as CONTENTS
+NO_CONTENTS = [SHT_NULL, SHT_SYMTAB, SHT_STRTAB, SHT_RELA, SHT_NOBITS, SHT_REL]
+
+SHSTRTAB_NAMES = "\0.symtab\0.strtab\0.shstrtab\0"
+
+
+def elf_class(data, fn="<data>"):
+    if data[:4] != "\x7f\x45\x4c\x46" or not ELF_CLASSES.has_key(data[4:7]):
+        raise Exception, "%s is not %s" % (fn, "ELF")
+    return ELF_CLASSES[data[4:7]]
+
+
+# Returns a list of (name, sh_type, sh_flags, sh_addr, sh_offset,
+# sh_size, sh_link, sh_info, sh_addralign, sh_entsize), or None if the
+# section header table is unusable. Only the table and .shstrtab are
+# read, so data can be a large mmap.
+def read_sections(data, fn="<data>"):
+    name, ehsize, ehdr, shdr = elf_class(data, fn)
+    eh = ehdr.unpack_from(data, 16)
+    e_shoff, e_shentsize, e_shnum, e_shstrndx = eh[5], eh[10], eh[11], eh[12]
+    if e_shnum == 0 or e_shoff < ehsize or e_shentsize < shdr.size:
+        return None
+    if e_shoff + e_shnum * e_shentsize > len(data) or e_shstrndx >= e_shnum:
+        return None
+    sections = []
+    for i in range(e_shnum):
+        sections.append(list(shdr.unpack_from(data, e_shoff + i * e_shentsize)))
+    strtab = sections[e_shstrndx]
+    if strtab[4] + strtab[5] > len(data):
+        return None
+    names = data[strtab[4]:strtab[4]+strtab[5]]
+    for sh in sections:
+        p = names.find("\0", sh[0])
+        if sh[0] >= len(names) or p < 0:
+            return None
+        sh[0] = names[sh[0]:p]
+    return map(tuple, sections)
+
+
+# the end of the last section with contents
+def contents_extent(sections):
+    new_len = 0
+    for sh in sections:
+        if sh[1] not in NO_CONTENTS and sh[4] + sh[5] > new_len:
+            new_len = sh[4] + sh[5]
+    return new_len
+
+
+# Returns (e_ehsize, new file length), or None if there is nothing to
+# strip. data is a string or an mmap; fn is only used for messages and
+# arch checks. If a dump is given its CONTENTS extent must agree with
+# the section header table.
+def strip_extent(data, dump=None, fn="<data>"):
+    name, ehsize, ehdr, shdr = elf_class(data, fn)
+    eh = ehdr.unpack_from(data, 16)
+    e_shnum, e_shstrndx = eh[11], eh[12]
+    if e_shnum == 0 and e_shstrndx == 0:
+        # already stripped
+        return None
+    assert e_shstrndx + 3 == e_shnum
+
+    sections = read_sections(data, fn)
+    # the section names that objcopy-2.17 writes into .shstrtab
+    pos = -1
+    if sections is not None:
+        sh = sections[e_shstrndx]
+        pos = data.find(SHSTRTAB_NAMES, sh[4], sh[4] + sh[5])
+    if pos < 0:
+        pos = data.find(SHSTRTAB_NAMES, ehsize)
+    if sections is not None:
+        new_len = contents_extent(sections)
+        if dump is not None:
+            assert new_len == dump_extent(dump), ("section table and dump differ", new_len, dump_extent(dump))
+    elif dump is not None:
+        new_len = dump_extent(dump)
+    else:
+        new_len = pos
+
+    # pos and new_len are relative to the end of the ELF header
+    if pos >= 0:
+        pos -= ehsize
+    if new_len > ehsize:
+        new_len = min(new_len, len(data)) - ehsize
+    else:
+        new_len = len(data) - ehsize
+    # Other compilers can intermix the contents of .rela sections
+    # with PROGBITS sections.  This happens on powerpc64le and arm64.
+    if re.search(r"^powerpc64", os.path.basename(fn)):
+        assert pos >= new_len, ("unexpected strip extent", pos, new_len)
+    elif re.search(r"^arm64-", os.path.basename(fn)):
+        assert pos >= new_len, ("unexpected strip extent", pos, new_len)
+    else:
+        assert pos == new_len, ("unexpected strip extent", pos, new_len)
+
+    if new_len > 0:
+        return ehsize, ehsize + new_len
+    return None
+
+
+# library API: return the stripped ELF file, or None if there is
+# nothing to strip
+def strip_elf(idata, dump=None, fn="<data>"):
+    r = strip_extent(idata, dump, fn)
+    if r is None:
+        return None
+    ehsize, new_len = r
+    # clear e_shnum, e_shstrndx
+    return idata[:ehsize-4] + struct.pack("I", 0) + idata[ehsize:new_len]
+
+
+# /***********************************************************************
+# // section compaction
+# ************************************************************************/
+
+# Other compilers can leave relocation payloads and alignment padding
+# between the sections with contents (powerpc64 and arm64). ElfLinker
+# only reads each section at its offset and applies the 2**N alignment
+# from the dump itself in addLoader(), so the contents can be packed
+# without any gaps. Returns ([(name, old offset, size, new offset)],
+# new file length), in file order starting at e_ehsize.
+def compact_layout(sections, ehsize):
+    contents = [sh for sh in sections if sh[1] not in NO_CONTENTS]
+    contents.sort(key=lambda sh: sh[4])
+    moves, pos, end = [], ehsize, ehsize
+    for sh in contents:
+        assert sh[4] >= end, ("overlapping sections", sh[0])
+        moves.append((sh[0], sh[4], sh[5], pos))
+        pos += sh[5]
+        end = sh[4] + sh[5]
+    return moves, pos
+
+
+# rewrite the "File off" column of the dump for the new layout
+def compact_dump(dump, moves):
+    psections = dump.find("Sections:\n")
+    psymbols = dump.find("SYMBOL TABLE:\n", psections)
+    assert 0 <= psections < psymbols
+    new = dict([(m[0], m[3]) for m in moves])
+    done = {}
+    def repl(m):
+        name, off = m.group(2), m.group(3)
+        done[name] = 1
+        return m.group(1) + "%0*x" % (len(off), new[name]) + m.group(4)
+    d = re.sub(r"(?m)^(\s*\d+\s+(\S+)\s+[0-9a-fA-F]+\s+[0-9a-fA-F]+\s+[0-9a-fA-F]+\s+)([0-9a-fA-F]+)(\s+2\*\*)",
+               repl, dump[psections:psymbols])
+    assert len(done) == len(new), ("sections missing in dump", sorted(new.keys()), sorted(done.keys()))
+    return dump[:psections] + d + dump[psymbols:]
+
+
+# library API: return (the stripped and compacted ELF file, the dump
+# with the new section offsets), or None if there is nothing to strip
+def compact_elf(idata, dump, fn="<data>"):
+    r = strip_extent(idata, dump, fn)
+    sections = read_sections(idata, fn)
+    if r is None:
+        return None
+    assert sections is not None, ("%s: no section header table" % fn)
+    ehsize = r[0]
+    moves, new_len = compact_layout(sections, ehsize)
+    out = [idata[:ehsize-4], struct.pack("I", 0)]
+    for name, offset, size, pos in moves:
+        out.append(idata[offset:offset+size])
+    odump = compact_dump(dump, moves)
+    assert dump_extent(odump) == new_len
+    return "".join(out), odump
+
+
+def read_dump(dump_fn):
+    fp = open(dump_fn, "rb")
+    dump = fp.read()
+    fp.close()
+    return dump
+
+
+# Strip fn in place: the file is mapped, only e_shnum and e_shstrndx
+# get written, and then the file is truncated. No section contents are
+# read or copied - except with --compact, which packs the sections
+# (see compact_layout()) and writes the new offsets into the dump
+# (--with-dump, default FILE.dump). Returns (stripped length, final
+# length), or None if there was nothing to strip.
 def do_file(fn):
-    odata = None
+    dump, dump_fn = None, opts.with_dump
+    if opts.compact and not dump_fn:
+        dump_fn = fn + ".dump"
+    if dump_fn:
+        dump = read_dump(dump_fn)
     if opts.dry_run:
         fp = open(fn, "rb")
     else:
         fp = open(fn, "r+b")
-    fp.seek(0, 0)
-    idata = fp.read()
-    if idata[:4] != "\x7f\x45\x4c\x46":
-        raise Exception, "%s is not %s" % (fn, "ELF")
-    if idata[4:7] == "\x01\x01\x01":
-        # ELF32 LE
-        eh, idata = idata[:52], idata[52:]
-        e_shnum, e_shstrndx = struct.unpack("<HH", eh[48:52])
-        assert e_shstrndx + 3 == e_shnum
-        ##eh = eh[:48] + struct.pack("<HH", e_shnum - 3, e_shstrndx)
-    elif idata[4:7] == "\x01\x02\x01":
-        # ELF32 BE
-        eh, idata = idata[:52], idata[52:]
-        e_shnum, e_shstrndx = struct.unpack(">HH", eh[48:52])
-        assert e_shstrndx + 3 == e_shnum
-    elif idata[4:7] == "\x02\x01\x01":
-        # ELF64 LE
-        eh, idata = idata[:64], idata[64:]
-        e_shnum, e_shstrndx = struct.unpack("<HH", eh[60:64])
-        assert e_shstrndx + 3 == e_shnum
-    elif idata[4:7] == "\x02\x02\x01":
-        # ELF64 BE
-        eh, idata = idata[:64], idata[64:]
-        e_shnum, e_shstrndx = struct.unpack(">HH", eh[60:64])
-        assert e_shstrndx + 3 == e_shnum
-    else:
-        raise Exception, "%s is not %s" % (fn, "ELF")
-
-    odata = None
-    pos = idata.find("\0.symtab\0.strtab\0.shstrtab\0")
-    if opts.with_dump:
-        eh, odata = strip_with_dump(opts.with_dump, eh, idata)
-        # Other compilers can intermix the contents of .rela sections
-        # with PROGBITS sections.  This happens on powerpc64le and arm64.
-        # The general solution probably requires a C++ program
-        # that combines "objcopy -R", "objdump -htr", and xstrip.
-        if re.search(r"^powerpc64", os.path.basename(fn)):
-            assert pos >= len(odata), ("unexpected strip_with_dump", pos, len(odata))
-        elif re.search(r"^arm64-", os.path.basename(fn)):
-            assert pos >= len(odata), ("unexpected strip_with_dump", pos, len(odata))
+    try:
+        if os.fstat(fp.fileno()).st_size < 64:
+            # too small to map (and to be a strippable object)
+            r = strip_extent(fp.read(), dump, fn)
+            assert r is None
+            return
+        if opts.dry_run:
+            m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
         else:
-            assert pos == len(odata), ("unexpected strip_with_dump", pos, len(odata))
-    else:
-        if pos >= 0:
-            odata = idata[:pos]
-
-    if eh and odata and not opts.dry_run:
-        fp.seek(0, 0)
-        fp.write(eh[:-4])  # all but e_shnum, e_shstrndx
-        fp.write(struct.pack("I", 0))  # clear e_shnum, e_shstrndx
-        fp.write(odata)
-        fp.truncate()
-    fp.close()
+            m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_WRITE)
+        try:
+            r = strip_extent(m, dump, fn)
+            if r:
+                ehsize, new_len = r
+                r = (new_len, new_len)
+            if r and opts.compact:
+                sections = read_sections(m, fn)
+                assert sections is not None, ("%s: no section header table" % fn)
+                moves, compact_len = compact_layout(sections, ehsize)
+                odump = compact_dump(dump, moves)
+                assert dump_extent(odump) == compact_len
+                r = (new_len, compact_len)
+            if r and not opts.dry_run:
+                m[ehsize-4:ehsize] = struct.pack("I", 0)
+                if opts.compact:
+                    # the sections only move down, so in file order
+                    # each move leaves the ones still to come intact
+                    for name, offset, size, pos in moves:
+                        if pos != offset:
+                            m.move(pos, offset, size)
+        finally:
+            m.close()
+        if r and not opts.dry_run:
+            fp.truncate(r[1])
+            if opts.compact and odump != dump:
+                dfp = open(dump_fn, "wb")
+                dfp.write(odump)
+                dfp.close()
+    finally:
+        fp.close()
+    return r
 
 
 def main(argv):
@@ -196,13 +377,14 @@ def main(argv):
     except AssertionError: pass
     else: raise Exception("fatal error - assertions not enabled")
     shortopts, longopts = "qv", [
-        "dry-run", "quiet", "verbose", "with-dump="
+        "compact", "dry-run", "quiet", "verbose", "with-dump="
     ]
     xopts, args = getopt.gnu_getopt(argv[1:], shortopts, longopts)
     for opt, optarg in xopts:
         if 0: pass
         elif opt in ["-q", "--quiet"]: opts.verbose = opts.verbose - 1
         elif opt in ["-v", "--verbose"]: opts.verbose = opts.verbose + 1
+        elif opt in ["--compact"]: opts.compact = opts.compact + 1
         elif opt in ["--dry-run"]: opts.dry_run = opts.dry_run + 1
         elif opt in ["--with-dump"]: opts.with_dump = optarg
         else: assert 0, ("getopt problem:", opt, optarg, xopts, args)
@@ -211,9 +393,19 @@ def main(argv):
     if opts.with_dump or opts.bindump:
         assert len(args) == 1, "need exactly one file"
     # process arguments
+    sizes = {}
     for arg in args:
-        do_file(arg)
-        check_dump(opts.with_dump);
+        r = do_file(arg)
+        if opts.with_dump:
+            check_dump(read_dump(opts.with_dump))
+        if r:
+            arch = os.path.basename(arg).split("-")[0]
+            t = sizes.setdefault(arch, [0, 0, 0])
+            t[0], t[1], t[2] = t[0] + 1, t[1] + r[0], t[2] + r[1]
+    if opts.compact and opts.verbose >= 0:
+        for arch in sorted(sizes.keys()):
+            n, old, new = sizes[arch]
+            print "%s: %d file(s), %d -> %d bytes, %d saved by --compact" % (arch, n, old, new, old - new)
     return 0
 
 
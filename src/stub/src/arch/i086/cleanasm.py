@@ -30,6 +30,9 @@
 
 import getopt, os, re, string, sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "scripts"))
+import outfile
+
 
 class opts:
     label_prefix = ".L"
@@ -446,7 +449,7 @@ def main(argv):
                         olines[i][3] = None
     #
     # write ofile
-    ofp = open(ofile, "wb")
+    ofp = outfile.OutputFile(ofile)
     current_label = None
     for label, inst, args, args_label in olines:
         if labels.has_key(label):
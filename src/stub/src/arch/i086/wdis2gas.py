@@ -30,6 +30,9 @@
 
 import getopt, os, re, string, sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "scripts"))
+import outfile
+
 
 class opts:
     arch = "i086"
@@ -121,7 +124,7 @@ def main(argv):
 
 
     # write ofile
-    ofp = open(ofile, "wb")
+    ofp = outfile.OutputFile(ofile)
     ofp.write(".code16\n")
     ofp.write(".intel_syntax noprefix\n")
     if opts.arch in ["i086", "8086", "i8086"]: